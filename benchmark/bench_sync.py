@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+"""
+bench_sync is an offline benchmark and load generator for the MPIJob
+sync hook (charts/mpi-operator/configs/sync.py).
+
+It generates synthetic MetaController observed payloads and measures:
+ - micro: the child builders and deep_merge_dicts
+ - sync: in-process calls to Controller.sync
+ - http: a local server under concurrent keep-alive load
+
+Results are written as JSON so that runs can be compared between commits:
+    python3 benchmark/bench_sync.py --output new.json --compare old.json
+No cluster is required.
+"""
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+SYNC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'charts', 'mpi-operator', 'configs', 'sync.py')
+
+LAYERS = ['micro', 'sync', 'http']
+CHILD_STATES = ['new', 'waiting', 'running', 'finished']
+
+
+def load_sync(path=SYNC_PATH):
+    """
+    Import sync.py as a module without starting the server
+    """
+    spec = importlib.util.spec_from_file_location('sync', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def new_parent(name, replicas, containers, env, volumes, generation=1):
+    """
+    Generate a synthetic MPIJob
+    """
+    spec = {
+        'replicas': replicas,
+        'slots': 2,
+        'image': 'mpibase:latest',
+        'template': {
+            'metadata': {'labels': {'mpi-app': name}},
+            'spec': {
+                'containers': [
+                    {'name': '%s-%d' % (name, idx),
+                     'image': 'mpibase:latest',
+                     'command': ['mpiexec'],
+                     'args': ['--allow-run-as-root', 'hostname'],
+                     'env': [{'name': 'VAR_%d' % i, 'value': 'x' * 32}
+                             for i in range(env)],
+                     'volumeMounts': [{'mountPath': '/mnt/vol-%d' % i,
+                                       'name': 'vol-%d' % i}
+                                      for i in range(volumes)]}
+                    for idx in range(containers)],
+                'volumes': [{'name': 'vol-%d' % i, 'emptyDir': {}}
+                            for i in range(volumes)]}}}
+    return {'apiVersion': 'skatelescope.org/v1',
+            'kind': 'MPIJob',
+            'metadata': {'name': name,
+                         'namespace': 'default',
+                         'uid': 'uid-%s' % name,
+                         'generation': generation,
+                         'creationTimestamp': '2019-01-01T00:00:00Z'},
+            'spec': spec}
+
+
+def new_children(module, parent, state):
+    """
+    Generate observed children for a parent in one of CHILD_STATES.
+    Each child carries the full rendered spec, as the MetaController sends.
+    """
+    children = {'ConfigMap.v1': {},
+                'Job.batch/v1': {},
+                'Role.rbac.authorization.k8s.io/v1': {},
+                'RoleBinding.rbac.authorization.k8s.io/v1': {},
+                'Service.v1': {},
+                'ServiceAccount.v1': {},
+                'StatefulSet.apps/v1': {}}
+    if state == 'new':
+        return children
+
+    replicas = parent['spec']['replicas']
+    ready = replicas if state != 'waiting' else replicas // 2
+    # render every child, including the launcher, without touching the cache
+    cache, module.SYNC_CACHE = module.SYNC_CACHE, module.SyncCache(0)
+    rendered = module.Controller.sync(
+        None, dict(parent, spec=dict(parent['spec'], waitForWorkers=False)),
+        children)['children']
+    module.SYNC_CACHE = cache
+    for child in rendered:
+        child = dict(child)
+        if child['kind'] == 'StatefulSet':
+            child['status'] = {'replicas': replicas,
+                               'currentReplicas': replicas,
+                               'readyReplicas': ready}
+        elif child['kind'] == 'Job':
+            if state == 'running':
+                child['status'] = {'active': 1,
+                                   'startTime': '2019-01-01T00:01:00Z'}
+            elif state == 'finished':
+                child['status'] = {
+                    'succeeded': 1,
+                    'startTime': '2019-01-01T00:01:00Z',
+                    'completionTime': '2019-01-01T00:02:00Z',
+                    'conditions': [
+                        {'type': 'Complete', 'status': 'True',
+                         'lastTransitionTime': '2019-01-01T00:02:00Z'}]}
+        kind = '%s.%s' % (child['kind'], child['apiVersion'])
+        children.setdefault(kind, {})[child['metadata']['name']] = child
+    if state == 'waiting':
+        children['Job.batch/v1'] = {}
+    return children
+
+
+def timed(func, number, repeat):
+    """
+    Per call timings in microseconds of func
+    """
+    runs = timeit.repeat(func, number=number, repeat=repeat)
+    per_call = [run / number * 1e6 for run in runs]
+    return {'unit': 'us',
+            'calls': number * repeat,
+            'min': min(per_call),
+            'median': statistics.median(per_call),
+            'max': max(per_call)}
+
+
+def percentile(ordered, fraction):
+    """
+    Nearest rank percentile of an ordered list
+    """
+    if not ordered:
+        return None
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def bench_micro(module, params, args):
+    """
+    Microbenchmarks of the merge and the child builders
+    """
+    parent = new_parent('bench', **params)
+    job = module.MPIJob(parent)
+    base = module.new_mpilauncher(module.MPIJob(
+        new_parent('base', params['replicas'], 0, 0, 0),
+        job.name))['spec']['template']
+    template = parent['spec']['template']
+    cases = {
+        'deep_merge_dicts': lambda: module.deep_merge_dicts(base, template),
+        'parse_mpijob': lambda: module.MPIJob(parent),
+        'new_mpiset': lambda: module.new_mpiset(job),
+        'new_mpilauncher': lambda: module.new_mpilauncher(job),
+        'new_configmap': lambda: module.new_configmap(job)}
+    return [{'layer': 'micro', 'name': case, 'params': params,
+             'stats': timed(func, args.number, args.repeat)}
+            for case, func in sorted(cases.items())]
+
+
+def bench_sync(module, params, args):
+    """
+    In-process Controller.sync calls, with and without the result cache
+    """
+    results = []
+    parent = new_parent('bench', **params)
+    for state in CHILD_STATES:
+        children = new_children(module, parent, state)
+        for cached in (False, True):
+            module.SYNC_CACHE = module.SyncCache(1024 if cached else 0)
+            module.Controller.sync(None, parent, children)
+            stats = timed(
+                lambda: module.Controller.sync(None, parent, children),
+                args.number, args.repeat)
+            results.append({'layer': 'sync',
+                            'name': 'sync[%s%s]' % (
+                                state, ',cached' if cached else ''),
+                            'params': dict(params, state=state,
+                                           cached=cached),
+                            'stats': stats})
+    module.SYNC_CACHE = module.SyncCache()
+    return results
+
+
+class QuietController(object):  # pylint: disable=too-few-public-methods
+    """
+    Mixin that drops the per-request access log line
+    """
+    def log_message(self, *_):  # pylint: disable=no-self-use
+        """
+        no access log
+        """
+        return
+
+
+def bench_http(module, params, args):
+    """
+    Concurrent keep-alive load against a local server
+    """
+    handler = type('BenchController', (QuietController, module.Controller),
+                   {})
+    server = module.SERVERS[args.server](
+        ('127.0.0.1', 0), handler, max_inflight=args.max_inflight,
+        queue_timeout=30, keepalive_timeout=30)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+
+    # distinct jobs, so that the cache only helps on resyncs
+    bodies = []
+    for idx in range(args.jobs):
+        parent = new_parent('bench-%d' % idx, **params)
+        children = new_children(module, parent, args.state)
+        bodies.append(json.dumps({'parent': parent,
+                                  'children': children}).encode())
+
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        mine = []
+        while True:
+            idx = next(counter)
+            if idx >= args.requests:
+                break
+            body = bodies[idx % len(bodies)]
+            start = time.perf_counter()
+            try:
+                conn.request('POST', '/sync', body,
+                             {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise IOError('status %d' % response.status)
+            except (IOError, http.client.HTTPException) as err:
+                with lock:
+                    errors.append(str(err))
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                  timeout=60)
+                continue
+            mine.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client)
+               for _ in range(args.concurrency)]
+    for worker in clients:
+        worker.start()
+    for worker in clients:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    stats = {'unit': 'ms',
+             'requests': len(latencies),
+             'errors': len(errors),
+             'seconds': elapsed,
+             'throughput': len(latencies) / elapsed if elapsed else None,
+             'request_bytes': statistics.mean(len(body) for body in bodies),
+             'p50': percentile(latencies, 0.50) * 1e3 if latencies else None,
+             'p90': percentile(latencies, 0.90) * 1e3 if latencies else None,
+             'p99': percentile(latencies, 0.99) * 1e3 if latencies else None,
+             'max': latencies[-1] * 1e3 if latencies else None}
+    return [{'layer': 'http',
+             'name': 'http[%s,%s]' % (args.server, args.state),
+             'params': dict(params, server=args.server, state=args.state,
+                            concurrency=args.concurrency, jobs=args.jobs),
+             'stats': stats}]
+
+
+BENCHES = {'micro': bench_micro,
+           'sync': bench_sync,
+           'http': bench_http}
+
+
+def git_commit():
+    """
+    The commit being measured, if known
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    """
+    Identify a result across runs
+    """
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(old, new):
+    """
+    Print the change in the headline figure of each result
+    """
+    previous = {result_key(result): result for result in old['results']}
+    for result in new['results']:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+        metric = 'p50' if result['layer'] == 'http' else 'median'
+        was, now = before['stats'][metric], result['stats'][metric]
+        if not was or now is None:
+            continue
+        print('%-28s %-60s %10.1f -> %10.1f %s (%+.1f%%)' % (
+            result['name'],
+            json.dumps(result['params'], sort_keys=True)[:60],
+            was, now, result['stats']['unit'], (now - was) / was * 100),
+              file=sys.stderr)
+
+
+def int_list(value):
+    """
+    argparse type for a comma separated list of integers
+    """
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks for the MPIJob sync hook')
+    parser.add_argument('--layers', default=','.join(LAYERS),
+                        help='comma separated layers to run (default: %s)' %
+                        ','.join(LAYERS))
+    parser.add_argument('--replicas', type=int_list, default=[2, 64, 1000],
+                        help='worker replicas to try (default: 2,64,1000)')
+    parser.add_argument('--containers', type=int_list, default=[1],
+                        help='containers per template (default: 1)')
+    parser.add_argument('--env', type=int_list, default=[2, 200],
+                        help='env vars per container (default: 2,200)')
+    parser.add_argument('--volumes', type=int_list, default=[1, 50],
+                        help='volumes per template (default: 1,50)')
+    parser.add_argument('--number', type=int, default=50,
+                        help='calls per timing run (default: 50)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs (default: 5)')
+    parser.add_argument('--server', default='threaded',
+                        help='http: serving engine (default: threaded)')
+    parser.add_argument('--max-inflight', type=int, default=8,
+                        help='http: server concurrent syncs (default: 8)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='http: client connections (default: 8)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='http: total requests (default: 2000)')
+    parser.add_argument('--jobs', type=int, default=100,
+                        help='http: distinct MPIJobs (default: 100)')
+    parser.add_argument('--state', choices=CHILD_STATES, default='running',
+                        help='http: observed children state '
+                        '(default: running)')
+    parser.add_argument('--sync', default=SYNC_PATH,
+                        help='sync.py to benchmark')
+    parser.add_argument('--log', action='store_true',
+                        help='log at DEBUG through the sync hook logging '
+                        'pipeline')
+    parser.add_argument('--output', default='-',
+                        help='JSON results file (default: stdout)')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='previous results to compare against')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the benchmarks
+    """
+    args = parse_args(argv)
+    module = load_sync(args.sync)
+    if args.log:
+        module.configure_logging('DEBUG')
+    else:
+        logging.disable(logging.CRITICAL)
+
+    results = []
+    for layer in args.layers.split(','):
+        for replicas, containers, env, volumes in itertools.product(
+                args.replicas, args.containers, args.env, args.volumes):
+            params = {'replicas': replicas, 'containers': containers,
+                      'env': env, 'volumes': volumes}
+            print('%s %s' % (layer, json.dumps(params)), file=sys.stderr)
+            results.extend(BENCHES[layer](module, params, args))
+
+    report = {'meta': {'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'json_backend': ('orjson' if module.orjson is not None
+                                        else 'json'),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                             time.gmtime()),
+                       'argv': sys.argv[1:] if argv is None else argv},
+              'results': results}
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
+
+
+if __name__ == '__main__':
+    main()
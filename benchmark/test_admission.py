@@ -0,0 +1,163 @@
+"""
+Unit tests for the admission ledger in the MPIJob sync hook
+(charts/mpi-operator/configs/sync.py):
+    python3 -m pytest benchmark
+"""
+import pytest
+
+from bench_sync import load_sync
+
+SYNC = load_sync()
+
+
+class Clock(object):
+    """
+    A monotonic clock that only moves when told to
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        """
+        The current time
+        """
+        return self.now
+
+
+@pytest.fixture(name='clock')
+def fixture_clock(monkeypatch):
+    """
+    Run the ledger on a Clock
+    """
+    clock = Clock()
+    monkeypatch.setattr(SYNC.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def mpijob(name, priority=0, minute=0, namespace='default'):
+    """
+    An MPIJob created minute minutes past midnight
+    """
+    return SYNC.MPIJob({
+        'metadata': {'name': name, 'namespace': namespace,
+                     'uid': 'uid-' + name,
+                     'creationTimestamp': '2026-10-17T00:%02d:00Z' % minute},
+        'spec': {'replicas': 1, 'priority': priority,
+                 'template': {'spec': {'containers': [
+                     {'name': name, 'image': 'mpibase:latest'}]}}}})
+
+
+def test_no_capacity(clock):
+    """
+    without a capacity every job is admitted
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger()
+    assert ledger.admit(mpijob('a'), 10 ** 6) == (True, None)
+    assert ledger.jobs == {}
+
+
+def test_priority_then_age(clock):
+    """
+    waiting jobs are admitted in order of priority then age
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger(4)
+    assert ledger.admit(mpijob('running'), 4) == (True, None)
+    old, high, new = mpijob('old', 0, 1), mpijob('high', 5, 3), \
+        mpijob('new', 0, 2)
+    assert ledger.admit(new, 2) == (False, 0)
+    assert ledger.admit(old, 2) == (False, 0)
+    assert ledger.admit(high, 2) == (False, 0)
+    assert ledger.admit(new, 2) == (False, 2)
+    assert ledger.admit(old, 2) == (False, 1)
+
+    ledger.release('uid-running')
+    # new would fit, but old and high come first
+    assert ledger.admit(new, 2) == (False, 2)
+    assert ledger.admit(old, 2) == (True, None)
+    assert ledger.admit(high, 2) == (True, None)
+    assert ledger.admit(new, 2) == (False, 0)
+    # once admitted a job stays admitted
+    assert ledger.admit(old, 2) == (True, None)
+    assert ledger.stats() == {'': {'capacity': 4, 'used': 4, 'queued': 1,
+                                   'queuedSlots': 2}}
+
+
+def test_strict_order(clock):
+    """
+    a small job does not overtake a large one waiting ahead of it
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger(4)
+    assert ledger.admit(mpijob('running'), 2) == (True, None)
+    assert ledger.admit(mpijob('large', 0, 1), 4) == (False, 0)
+    assert ledger.admit(mpijob('small', 0, 2), 1) == (False, 1)
+
+
+def test_exceeds_capacity(clock):
+    """
+    a job larger than the capacity never fits and holds up nobody
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger(4)
+    assert ledger.admit(mpijob('huge', 0, 1), 5) == (False, None)
+    assert ledger.admit(mpijob('small', 0, 2), 4) == (True, None)
+    assert ledger.admit(mpijob('huge', 0, 1), 5) == (False, None)
+
+
+def test_per_namespace(clock):
+    """
+    each namespace has its own capacity
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger(4, per_namespace=True)
+    assert ledger.admit(mpijob('a', namespace='one'), 4) == (True, None)
+    assert ledger.admit(mpijob('b', namespace='two'), 4) == (True, None)
+    assert ledger.admit(mpijob('c', namespace='one'), 1) == (False, 0)
+
+
+def test_warmup(clock):
+    """
+    no new jobs are admitted while the ledger is rebuilt after a start
+    """
+    ledger = SYNC.AdmissionLedger(3, warmup=30)
+    assert ledger.admit(mpijob('new', 0, 2), 1) == (False, 0)
+    assert ledger.admit(mpijob('old', 0, 1), 1) == (False, 0)
+    # jobs that already have workers are still re-admitted
+    assert ledger.admit(mpijob('running'), 2, admitted=True) == (True, None)
+
+    clock.now += 31
+    assert ledger.admit(mpijob('new', 0, 2), 1) == (False, 1)
+    assert ledger.admit(mpijob('old', 0, 1), 1) == (True, None)
+    assert ledger.admit(mpijob('new', 0, 2), 1) == (False, 0)
+
+
+def test_rebuild(clock):
+    """
+    after a restart jobs that had workers are re-admitted even beyond
+    the capacity, and new jobs wait until enough of them finish
+    """
+    del clock
+    ledger = SYNC.AdmissionLedger(4)
+    assert ledger.admit(mpijob('a'), 4, admitted=True) == (True, None)
+    assert ledger.admit(mpijob('b'), 2, admitted=True) == (True, None)
+    assert ledger.admit(mpijob('c'), 1) == (False, 0)
+    assert ledger.stats()['']['used'] == 6
+
+    ledger.release('uid-a')
+    assert ledger.admit(mpijob('c'), 1) == (True, None)
+    assert ledger.admit(mpijob('b'), 2) == (True, None)
+
+
+def test_prune(clock):
+    """
+    jobs that are no longer synced give back their slots
+    """
+    ledger = SYNC.AdmissionLedger(4, stale=60)
+    assert ledger.admit(mpijob('gone'), 4) == (True, None)
+    assert ledger.admit(mpijob('waiting'), 4) == (False, 0)
+
+    clock.now += 61
+    assert ledger.admit(mpijob('waiting'), 4) == (True, None)
+    assert list(ledger.jobs) == ['uid-waiting']
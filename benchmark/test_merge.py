@@ -0,0 +1,118 @@
+"""
+Unit tests for the template merge in the MPIJob sync hook
+(charts/mpi-operator/configs/sync.py):
+    python3 -m pytest benchmark
+"""
+import copy
+
+from bench_sync import load_sync
+
+SYNC = load_sync()
+
+BUILTIN = {
+    'containers': [
+        {'name': 'mpioperator-test-worker',
+         'image': 'mpibase:latest',
+         'env': [{'name': 'OMPI_MCA_plm_rsh_agent', 'value': 'ssh'}],
+         'volumeMounts': [{'mountPath': '/etc/mpi',
+                           'name': 'mpi-job-config'}]}],
+    'volumes': [{'name': 'mpi-job-config',
+                 'configMap': {'name': 'mpioperator-test-config'}}]}
+
+
+def merge(original, incoming):
+    """
+    deep_merge_dicts, checking that neither argument is modified
+    """
+    before = copy.deepcopy((original, incoming))
+    merged = SYNC.deep_merge_dicts(original, incoming)
+    assert (original, incoming) == before
+    return merged
+
+
+def test_primary_container():
+    """
+    the first template container decorates the built-in one
+    """
+    merged = merge(BUILTIN, {'containers': [
+        {'name': 'test-mpi', 'image': 'mpiapp:1',
+         'env': [{'name': 'DEBUG', 'value': '1'}]},
+        {'name': 'sidecar', 'image': 'busybox'}]})
+    assert merged['containers'] == [
+        {'name': 'test-mpi',
+         'image': 'mpiapp:1',
+         'env': [{'name': 'OMPI_MCA_plm_rsh_agent', 'value': 'ssh'},
+                 {'name': 'DEBUG', 'value': '1'}],
+         'volumeMounts': [{'mountPath': '/etc/mpi',
+                           'name': 'mpi-job-config'}]},
+        {'name': 'sidecar', 'image': 'busybox'}]
+
+
+def test_primary_container_named():
+    """
+    a template container with the built-in name merges by name, and
+    nothing else is taken as the primary container
+    """
+    merged = merge(BUILTIN, {'containers': [
+        {'name': 'sidecar', 'image': 'busybox'},
+        {'name': 'mpioperator-test-worker', 'image': 'mpiapp:1'}]})
+    assert [(container['name'], container['image'])
+            for container in merged['containers']] == [
+                ('mpioperator-test-worker', 'mpiapp:1'),
+                ('sidecar', 'busybox')]
+
+
+def test_repeated_keys():
+    """
+    repeated keys merge into the first occurrence - never duplicated
+    """
+    merged = SYNC.deep_merge_keyed_lists(
+        [{'name': 'A', 'value': '1'}, {'name': 'B', 'value': '2'}],
+        [{'name': 'A', 'value': '3'}, {'name': 'C', 'value': '4'},
+         {'name': 'C', 'value': '5'}, {'name': 'A', 'value': '6'}],
+        'name')
+    assert merged == [{'name': 'A', 'value': '6'},
+                      {'name': 'B', 'value': '2'},
+                      {'name': 'C', 'value': '5'}]
+
+
+def test_unnamed_items():
+    """
+    items without the merge key are appended as they are
+    """
+    merged = merge(
+        {'env': [{'name': 'A', 'value': '1'}]},
+        {'env': [{'value': 'no name'}, 'not a map',
+                 {'name': 'A', 'value': '2'}]})
+    assert merged['env'] == [{'name': 'A', 'value': '2'},
+                             {'value': 'no name'}, 'not a map']
+
+
+def test_volume_mounts():
+    """
+    volumeMounts are keyed on mountPath, not name
+    """
+    merged = merge(BUILTIN, {'containers': [{
+        'name': 'test-mpi',
+        'volumeMounts': [{'mountPath': '/etc/mpi', 'readOnly': True},
+                         {'mountPath': '/data', 'name': 'mpi-job-config'}]}]})
+    assert merged['containers'][0]['volumeMounts'] == [
+        {'mountPath': '/etc/mpi', 'name': 'mpi-job-config',
+         'readOnly': True},
+        {'mountPath': '/data', 'name': 'mpi-job-config'}]
+
+
+def test_other_lists():
+    """
+    lists without a merge key merge by position
+    """
+    merged = merge(
+        {'args': ['-n', '2', 'hostname'],
+         'tolerations': [{'key': 'gpu', 'operator': 'Exists'}]},
+        {'args': ['-n', '4'],
+         'tolerations': [{'effect': 'NoSchedule'}, {'key': 'fpga'}]})
+    assert merged == {
+        'args': ['-n', '4', 'hostname'],
+        'tolerations': [{'key': 'gpu', 'operator': 'Exists',
+                         'effect': 'NoSchedule'},
+                        {'key': 'fpga'}]}
@@ -4,27 +4,165 @@ sync is a minimal HTTP server that responds to POST requests from
 the MetaController for the configuration of MPIJob objects in Kubernetes
 """
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs
+import argparse
+import calendar
+import contextlib
+import cProfile
+import gzip
+import hashlib
+import hmac
+import io
 import uuid
 import json
-import copy
+import functools
 import logging
-import sys
+import logging.handlers
+import marshal
+import os
+import pstats
+import queue
+import random
+import signal
+import threading
+import time
+import tracemalloc
+try:
+    import orjson  # pylint: disable=import-error
+except ImportError:
+    orjson = None  # pylint: disable=invalid-name
 WORKER_SUFFIX = "-worker"
+# the worker counts in the MPIJob status and the fields they come from
+WORKER_COUNTS = ('currentReplicas', 'readyReplicas', 'replicas')
+WORKER_STATUS_FIELDS = (
+    ('StatefulSet.apps/v1', WORKER_COUNTS),
+    ('DaemonSet.apps/v1', ('currentNumberScheduled', 'numberReady',
+                           'desiredNumberScheduled')))
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+# logging is set up by configure_logging() from main()
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s [%(name)s] %(levelname)s: %(message)s'
+ACCESS_LOG = logging.getLogger('access')
+# DEBUG payload dumps - the payloads of one request in PAYLOAD_LOG_EVERY
+# (0 for none) are logged, each cut to PAYLOAD_LOG_BYTES (0 for no limit)
+PAYLOAD_LOG_EVERY = 100
+PAYLOAD_LOG_BYTES = 4096
+PAYLOAD_LOG = threading.local()
 
-# kubectl delivery image passed in as argv[1]
+# kubectl delivery image - overridden by argv[1]
 KUBECTL_IMAGE = 'mpioperator/kubectl-delivery:latest'
-if len(sys.argv) > 1:
-    KUBECTL_IMAGE = sys.argv[1]
+# set on the launcher Job by its init stage once the hostfile is ready
+INIT_FINISHED_ANNOTATION = 'mpi.skatelescope.org/init-finished'
+# elastic jobs: how many workers the launcher hostfile used
+USED_REPLICAS_ANNOTATION = 'mpi.skatelescope.org/used-replicas'
 
 MPI_BASE_IMAGE = 'mpibase:latest'
 
+# JSON backends: (loads, dumps) where dumps returns bytes
+JSON_BACKENDS = {
+    'json': (json.loads,
+             lambda obj: json.dumps(obj, separators=(',', ':')).encode())}
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = (orjson.loads, orjson.dumps)
+JSON_LOADS, JSON_DUMPS = JSON_BACKENDS.get('orjson', JSON_BACKENDS['json'])
 
-def deep_merge_lists(original, incoming, alwaysadd=False):
+# responses at least this size are gzipped when the client accepts it
+GZIP_MIN_SIZE = 4096
+GZIP_LEVEL = 1
+
+# launcher Role rules: names lists every worker Pod, compact is
+# constant size but covers all Pods in the namespace
+RBAC_MODES = ['names', 'compact']
+RBAC_MODE = 'names'
+
+# seconds between resyncs requested for each phase of an MPIJob, with
+# up to RESYNC_JITTER of each interval added or taken away at random
+# so that jobs created together do not resync together; 0 leaves
+# resyncs to the MetaController (changes to the MPIJob or its children)
+RESYNC_INTERVALS = {'queued': 10,
+                    'scaling': 5,
+                    'launching': 5,
+                    'running': 60,
+                    'finished': 0}
+RESYNC_PHASES = {'Queued': 'queued',
+                 'WaitingForWorkers': 'scaling',
+                 'Launching': 'launching',
+                 'Running': 'running',
+                 'Finished': 'finished',
+                 'Failed': 'finished'}
+RESYNC_JITTER = 0.1
+
+# status.durations - (name, from timestamp, to timestamp)
+LIFECYCLE_DURATIONS = (
+    ('admissionSeconds', 'created', 'admitted'),
+    ('queueSeconds', 'created', 'workersScheduled'),
+    ('workerStartupSeconds', 'workersScheduled', 'workersReady'),
+    ('launchSeconds', 'workersReady', 'launcherStarted'),
+    ('runSeconds', 'launcherStarted', 'completed'),
+    ('totalSeconds', 'created', 'completed'))
+
+# ssh launch mode - key pair Secret mounted on launcher and workers
+DEFAULT_SSH_SECRET = 'mpi-ssh'
+SSH_PORT = 22
+SSH_KEY_DIR = '/etc/mpi-ssh'
+SSH_VOLUME_MOUNT = {'mountPath': SSH_KEY_DIR,
+                    'name': 'mpi-job-ssh',
+                    'readOnly': True}
+SSHD_COMMAND = ('mkdir -p /root/.ssh /run/sshd && ' +
+                'cp ' + SSH_KEY_DIR + '/authorized_keys /root/.ssh/ && ' +
+                'chmod 700 /root/.ssh && ' +
+                'chmod 600 /root/.ssh/authorized_keys && ' +
+                'exec /usr/sbin/sshd -De -p %d' % SSH_PORT)
+SSH_ARGS = ('-i ' + SSH_KEY_DIR + '/id_rsa -p %d ' % SSH_PORT +
+            '-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null')
+
+# distinct jobs whose base children skeletons are memoized
+SKELETON_CACHE_SIZE = 512
+
+LAUNCH_MODES = ('kubectl', 'ssh')
+# launcher container fields that each of spec.runs may set
+RUN_FIELDS = ('command', 'args', 'env')
+WORKER_KINDS = ('StatefulSet', 'DaemonSet')
+CLEANUP_POLICIES = ('Workers', 'None', 'All')
+# worker placement policies and their default topology keys
+PLACEMENT_POLICIES = OrderedDict([
+    ('pack', 'kubernetes.io/hostname'),
+    ('spread', 'kubernetes.io/hostname'),
+    ('zone', 'topology.kubernetes.io/zone')])
+PLACEMENT_MODES = ('soft', 'hard')
+
+# OpenMPI MCA parameters for spec.transport, written to the job ConfigMap
+# in place of build/rootfs/usr/etc/openmpi-mca-params.conf
+MCA_PARAMS_FILE = 'openmpi-mca-params.conf'
+MCA_PARAMS_BASE = OrderedDict([('orte_keep_fqdn_hostnames', 't'),
+                               ('plm_rsh_no_tree_spawn', '1')])
+TRANSPORT_PROFILES = OrderedDict([
+    ('tcp', OrderedDict([('btl', 'tcp,self')])),
+    # intra-node messages through /dev/shm - see spec.shmSize
+    ('shared-memory', OrderedDict([
+        ('btl', 'vader,tcp,self'),
+        ('btl_vader_single_copy_mechanism', 'none')])),
+    # fewer rendezvous round trips for mid-sized messages
+    ('large-eager', OrderedDict([
+        ('btl', 'vader,tcp,self'),
+        ('btl_vader_single_copy_mechanism', 'none'),
+        ('btl_vader_eager_limit', '32768'),
+        ('btl_tcp_eager_limit', '1048576'),
+        ('btl_tcp_rndv_eager_limit', '1048576'),
+        ('btl_tcp_sndbuf', '0'),
+        ('btl_tcp_rcvbuf', '0')]))])
+DEFAULT_INTERFACE = 'eth0'
+
+# per thread request body buffers
+BUFFERS = threading.local()
+
+
+def deep_merge_lists(original, incoming):
     """
-    Deep merge two lists. Modifies original.
+    Deep merge two lists by position. Neither list is modified - the result
+    shares any elements that the merge does not touch.
     Reursively call deep merge on each correlated element of list.
     If item type in both elements are
      a. dict: call deep_merge_dicts on both values.
@@ -35,83 +173,346 @@ def deep_merge_lists(original, incoming, alwaysadd=False):
     If length of incoming list is more that of original then extra
      values are appended.
     """
-    if not alwaysadd:
-        common_length = min(len(original), len(incoming))
-        for idx in range(common_length):
-            if isinstance(original[idx], dict) and \
-               isinstance(incoming[idx], dict):
-                deep_merge_dicts(original[idx], incoming[idx])
+    merged = list(original)
+    common_length = min(len(original), len(incoming))
+    for idx in range(common_length):
+        if isinstance(original[idx], dict) and \
+           isinstance(incoming[idx], dict):
+            merged[idx] = deep_merge_dicts(original[idx], incoming[idx])
 
-            elif (isinstance(original[idx], list) and
-                  isinstance(incoming[idx], list)):
-                deep_merge_lists(original[idx], incoming[idx])
+        elif (isinstance(original[idx], list) and
+              isinstance(incoming[idx], list)):
+            merged[idx] = deep_merge_lists(original[idx], incoming[idx])
 
-            else:
-                original[idx] = incoming[idx]
+        else:
+            merged[idx] = incoming[idx]
 
-        for idx in range(common_length, len(incoming)):
-            original.append(incoming[idx])
-    else:
-        for idx, _ in enumerate(incoming):
-            original.append(incoming[idx])
+    merged.extend(incoming[common_length:])
+    return merged
+
+
+def deep_merge_keyed_lists(original, incoming, merge_key, primary=False):
+    """
+    Strategic merge of two lists of dicts, as for a Kubernetes strategic
+    merge patch. Neither list is modified.
+    Items are matched on merge_key using an index built once, so the merge
+    is linear in the length of the lists:
+     a. matched: call deep_merge_dicts on both items.
+     b. unmatched (or without merge_key): item is appended.
+     c. repeated merge_key in incoming: merged into the first occurrence.
+
+    If primary is set, the first incoming item that matches nothing is
+     merged into the first original item instead - the user's main
+     container decorates the built-in one.
+    """
+    merged = list(original)
+    index = {}
+    for idx, item in enumerate(original):
+        if isinstance(item, dict) and merge_key in item:
+            index.setdefault(item[merge_key], idx)
+
+    if primary and original and isinstance(original[0], dict):
+        primary = original[0].get(merge_key) not in set(
+            item.get(merge_key) for item in incoming
+            if isinstance(item, dict))
+
+    for item in incoming:
+        if not isinstance(item, dict) or merge_key not in item:
+            merged.append(item)
+            continue
+        idx = index.get(item[merge_key])
+        if idx is None and primary:
+            idx = 0
+            primary = False
+        if idx is None:
+            index[item[merge_key]] = len(merged)
+            merged.append(item)
+        else:
+            merged[idx] = deep_merge_dicts(merged[idx], item)
+            index.setdefault(item[merge_key], idx)
+    return merged
+
+
+# list merge keys, as for a Kubernetes strategic merge patch
+MERGE_KEYS = {'containers': 'name',
+              'initContainers': 'name',
+              'env': 'name',
+              'volumes': 'name',
+              'volumeMounts': 'mountPath'}
 
 
 def deep_merge_dicts(original, incoming):
     """
-    Deep merge two dictionaries. Modfies original.
+    Deep merge two dictionaries. Neither dictionary is modified - the
+    result only copies the paths that the merge touches, and shares
+    everything else with original and incoming.
     For key conflicts if both values are:
      a. dict: Recursivley call deep_merge_dicts on both values.
-     b. list: Calls deep_merge_lists on both values.
+     b. list: Calls deep_merge_keyed_lists on both values for keys in
+        MERGE_KEYS, otherwise deep_merge_lists.
      c. any other type: Value is overridden.
      d. conflicting types: Value is overridden.
 
     """
-    special = ['volumeMounts', 'volumes', 'env']
-
+    merged = dict(original)
     for key in incoming:
         if key in original:
             if isinstance(original[key], dict) and \
                isinstance(incoming[key], dict):
-                deep_merge_dicts(original[key], incoming[key])
+                merged[key] = deep_merge_dicts(original[key], incoming[key])
 
             elif (isinstance(original[key], list) and
                   isinstance(incoming[key], list)):
-                deep_merge_lists(original[key], incoming[key],
-                                 (key in special))
+                if key in MERGE_KEYS:
+                    merged[key] = deep_merge_keyed_lists(
+                        original[key], incoming[key], MERGE_KEYS[key],
+                        primary=(key == 'containers'))
+                else:
+                    merged[key] = deep_merge_lists(original[key],
+                                                   incoming[key])
 
             else:
-                original[key] = incoming[key]
+                merged[key] = incoming[key]
         else:
-            original[key] = incoming[key]
+            merged[key] = incoming[key]
+    return merged
+
+
+def replace_path(obj, path, value):
+    """
+    Copy obj, replacing the value at path (a tuple of keys).  Only the
+    dictionaries along path are copied.
+    """
+    if not path:
+        return value
+    copied = dict(obj)
+    copied[path[0]] = replace_path(obj[path[0]], path[1:], value)
+    return copied
 
 
-def build_name(job):
+def build_name(parent):
     """
     Generate the Job name
     """
-    container = (job['metadata']['name']
-                 if 'name' in job['metadata'] else str(uuid.uuid4()))
+    metadata = parent.get('metadata', {})
+    container = (metadata['name']
+                 if 'name' in metadata else str(uuid.uuid4()))
     name = 'mpioperator-%s' % container
     return name
 
 
-def new_mpiset(job, name):
+class InvalidJob(ValueError):
+    """
+    The MPIJob spec cannot be rendered
     """
-    Create the MPI StatefulSet
-    This creates a series of Pods that use an MPI enabled image
-    to build a cluster
 
-    The spec section of the MPIJob definition is used to
-    decorate the container for things like volumes/mounts etc.
+
+def spec_int(spec, key, default, minimum):
+    """
+    Read an integer field of the MPIJob spec, checking its lower bound
+    """
+    value = spec.get(key, default)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidJob("spec.%s must be an integer, not %r" % (key, value))
+    if value < minimum:
+        raise InvalidJob("spec.%s must be at least %d, not %d" %
+                         (key, minimum, value))
+    return value
+
+
+def spec_enum(spec, key, choices, path='spec'):
+    """
+    Read a string field of the MPIJob spec that must be one of choices,
+    the first being the default
+    """
+    value = spec.get(key, choices[0])
+    if value not in choices:
+        raise InvalidJob("%s.%s must be one of %s, not %r" %
+                         (path, key, ', '.join(choices), value))
+    return value
+
+
+def spec_placement(spec):
+    """
+    Read spec.placement as a (policy, topologyKey, mode) tuple, or None
+    """
+    placement = spec.get('placement')
+    if not placement:
+        return None
+    policy = spec_enum(placement, 'policy', tuple(PLACEMENT_POLICIES),
+                       'spec.placement')
+    mode = spec_enum(placement, 'mode', PLACEMENT_MODES, 'spec.placement')
+    return (policy, placement.get('topologyKey') or
+            PLACEMENT_POLICIES[policy], mode)
+
+
+def spec_transport(spec):
+    """
+    Read spec.transport as a (profile, interface, params) tuple, or None
+    """
+    transport = spec.get('transport')
+    if not transport:
+        return None
+    profile = spec_enum(transport, 'profile', tuple(TRANSPORT_PROFILES),
+                        'spec.transport')
+    params = transport.get('params') or {}
+    if not isinstance(params, dict):
+        raise InvalidJob("spec.transport.params must be a map of MCA "
+                         "parameters")
+    return (profile, transport.get('interface') or DEFAULT_INTERFACE,
+            tuple(sorted((str(key), str(value))
+                         for key, value in params.items())))
+
+
+def spec_runs(spec):
+    """
+    Read spec.runs as a tuple of (run name, launcher container override)
+    """
+    runs = spec.get('runs', [])
+    if not isinstance(runs, list):
+        raise InvalidJob("spec.runs must be a list of launcher runs")
+    parsed = []
+    for index, run in enumerate(runs):
+        if not isinstance(run, dict):
+            raise InvalidJob("spec.runs[%d] must be a map" % index)
+        parsed.append((str(run.get('name', index)),
+                       {key: run[key] for key in RUN_FIELDS if key in run}))
+    names = [name for name, _ in parsed]
+    if len(set(names)) != len(names):
+        raise InvalidJob("spec.runs names must be unique")
+    return tuple(parsed)
+
+
+class MPIJob(object):  # pylint: disable=too-many-instance-attributes
+    """
+    The MPIJob fields that the builders read, parsed and validated once
+    per sync.  Child names observed by the MetaController are preferred
+    to generated ones so that all the children of a job agree.
+    """
+    __slots__ = ('uid', 'namespace', 'generation', 'created', 'spec',
+                 'status', 'priority',
+                 'template',
+                 'name', 'configname', 'jobname', 'labels',
+                 'worker_kind', 'replicas', 'min_replicas', 'slots',
+                 'daemon', 'image',
+                 'placement', 'shm_size', 'transport', 'launch_mode',
+                 'ssh_secret', 'tree_spawn', 'fast_start', 'kubectl_path',
+                 'wait_for_workers', 'workers_timeout',
+                 'ttl_after_finished', 'cleanup_policy', 'runs',
+                 'run_concurrency')
+
+    def __init__(self, parent, name=False, configname=False, jobname=False):
+        metadata = parent.get('metadata', {})
+        spec = parent.get('spec', {})
+        self.uid = metadata.get('uid')
+        self.namespace = metadata.get('namespace', '')
+        self.generation = metadata.get('generation')
+        self.created = parse_time(metadata.get('creationTimestamp'))
+        self.spec = spec
+        self.status = parent.get('status') or {}
+        self.template = spec.get('template') or {}
+
+        self.name = name or build_name(parent)
+        self.configname = configname or '%s-config' % self.name
+        self.jobname = jobname or '%s-launcher' % self.name
+        self.labels = {'group_name': 'skatelescope.org',
+                       'mpi_job_name': self.name,
+                       'app': self.name}
+
+        self.worker_kind = spec_enum(spec, 'workerKind', WORKER_KINDS)
+        # elastic: replicas is maxReplicas, the launcher starts once
+        # minReplicas are ready
+        self.replicas = spec_int(spec, 'maxReplicas',
+                                 spec_int(spec, 'replicas', 1, 1), 1)
+        self.min_replicas = spec_int(spec, 'minReplicas', self.replicas, 1)
+        if self.min_replicas > self.replicas:
+            raise InvalidJob("spec.minReplicas cannot be more than %d" %
+                             self.replicas)
+        # slots: auto leaves OpenMPI to count the cores of each node
+        self.slots = ('auto' if spec.get('slots') == 'auto'
+                      else spec_int(spec, 'slots', 1, 1))
+        self.daemon = bool(spec.get('daemon'))
+        self.image = spec.get('image') or MPI_BASE_IMAGE
+        self.placement = spec_placement(spec)
+        self.shm_size = (str(spec['shmSize']) if spec.get('shmSize')
+                         else None)
+        self.transport = spec_transport(spec)
+        if self.daemon and self.placement == (
+                'pack', 'kubernetes.io/hostname', 'hard'):
+            raise InvalidJob("daemon workers cannot be packed onto one node")
+        self.launch_mode = spec_enum(spec, 'launchMode', LAUNCH_MODES)
+        self.ssh_secret = (spec.get('sshSecret', DEFAULT_SSH_SECRET)
+                           if self.launch_mode == 'ssh' else None)
+        self.tree_spawn = bool(spec.get('treeSpawn', True))
+        self.kubectl_path = spec.get('kubectlPath') or None
+        self.fast_start = bool(spec.get('fastStart') or self.kubectl_path)
+        self.wait_for_workers = bool(spec.get('waitForWorkers', True))
+        self.workers_timeout = spec_int(spec, 'workersTimeoutSeconds',
+                                        None, 1)
+        self.ttl_after_finished = spec_int(spec, 'ttlSecondsAfterFinished',
+                                           0, 0)
+        self.cleanup_policy = spec_enum(spec, 'cleanupPolicy',
+                                        CLEANUP_POLICIES)
+        self.priority = spec_int(spec, 'priority', 0, -2 ** 31)
+        self.runs = spec_runs(spec)
+        self.run_concurrency = spec_int(spec, 'runConcurrency', 1, 1)
+        if self.runs:
+            # the observed Job is one of the runs
+            self.jobname = '%s-launcher' % self.name
+
+
+def ssh_volume(secret):
+    """
+    Volume for the ssh key pair Secret
     """
-    if not name:
-        name = build_name(job)
-    replicas = int(job['spec']['replicas'] if 'replicas' in job['spec'] else 1)
+    return {'name': 'mpi-job-ssh',
+            'secret': {'defaultMode': 256,
+                       'secretName': secret}}
 
-    image = MPI_BASE_IMAGE
-    if 'image' in job['spec']:
-        image = job['spec']['image']
 
+def new_mpiservice(job):
+    """
+    Headless Service for the worker StatefulSet, giving each worker a
+    stable DNS name for ssh launch mode
+    """
+    name = job.name
+    service = {
+        'apiVersion': 'v1',
+        'kind': 'Service',
+        'metadata': {
+            'labels': job.labels,
+            'name': '%s-worker' % name
+            },
+        'spec': {
+            'clusterIP': 'None',
+            # workers must resolve before they are ready
+            'publishNotReadyAddresses': True,
+            'ports': [{'name': 'ssh',
+                       'port': SSH_PORT,
+                       'protocol': 'TCP',
+                       'targetPort': SSH_PORT}],
+            'selector': {
+                'group_name': 'skatelescope.org',
+                'mpi_job_name': name,
+                'mpi_role_type': 'worker',
+                'mpi_job_role': '%s-worker' % name}
+            }
+        }
+    return service
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def mpiset_skeleton(name, image, replicas, configname, daemon,
+                    ssh_secret=None, placement=None, shm_size=None,
+                    mca_params_file=False):
+    """
+    The base MPI StatefulSet before the MPIJob template is merged in.
+    The result is shared between calls and must not be modified.
+    """
     mpiset = {
         'apiVersion': 'apps/v1',
         'kind': 'StatefulSet',
@@ -171,7 +572,7 @@ def new_mpiset(job, name):
                                  'mode': 365,
                                  'path': 'kubexec.sh'}
                             ],
-                            'name': configmap_name(job)},
+                            'name': configname},
                          'name': 'mpi-job-config'}
                     ]
                 }
@@ -182,7 +583,7 @@ def new_mpiset(job, name):
             'type': 'RollingUpdate'
         }
     }
-    if 'daemon' in job['spec'] and job['spec']['daemon']:
+    if daemon:
         mpiset['spec']['template']['spec']['affinity'] = {'podAntiAffinity': {
             'requiredDuringSchedulingIgnoredDuringExecution': [
                 {'labelSelector': {
@@ -191,113 +592,247 @@ def new_mpiset(job, name):
                          'operator': 'In',
                          'values': ['%s-worker' % name]}]},
                  'topologyKey': 'kubernetes.io/hostname'}]}}
+    if placement:
+        worker_placement(mpiset['spec']['template']['spec'], name, *placement)
+    if ssh_secret:
+        # workers run sshd for the launcher and for tree spawn
+        pod = mpiset['spec']['template']['spec']
+        container = pod['containers'][0]
+        container['command'] = ['/bin/sh', '-c']
+        container['args'] = [SSHD_COMMAND]
+        container['ports'] = [{'containerPort': SSH_PORT,
+                               'name': 'ssh',
+                               'protocol': 'TCP'}]
+        container['readinessProbe'] = {'tcpSocket': {'port': SSH_PORT},
+                                       'periodSeconds': 2}
+        container['volumeMounts'].append(SSH_VOLUME_MOUNT)
+        pod['volumes'].append(ssh_volume(ssh_secret))
+    pod_tuning(mpiset['spec']['template']['spec'], shm_size, mca_params_file)
+    return mpiset
+
+
+def pod_tuning(pod, shm_size=None, mca_params_file=False):
+    """
+    Add a memory backed /dev/shm and the job MCA parameters file to the
+    MPI container of a Pod spec
+    """
+    container = pod['containers'][0]
+    if shm_size:
+        container['volumeMounts'].append({'mountPath': '/dev/shm',
+                                          'name': 'mpi-job-shm'})
+        pod['volumes'].append({'name': 'mpi-job-shm',
+                               'emptyDir': {'medium': 'Memory',
+                                            'sizeLimit': shm_size}})
+    if mca_params_file:
+        container.setdefault('env', []).append(
+            {'name': 'OMPI_MCA_mca_base_param_files',
+             'value': '/etc/mpi/' + MCA_PARAMS_FILE})
+        for volume in pod['volumes']:
+            if volume['name'] == 'mpi-job-config':
+                volume['configMap']['items'].append(
+                    {'key': MCA_PARAMS_FILE,
+                     'mode': 292,
+                     'path': MCA_PARAMS_FILE})
+
+
+def worker_placement(pod, name, policy, topology_key, mode):
+    """
+    Add the scheduling constraints for a placement policy to the worker
+    Pod spec.  pack and zone co-locate the workers within a topology
+    domain with podAffinity, spread balances them across domains with a
+    topologySpreadConstraint.
+    """
+    selector = {'matchLabels': {'mpi_job_role': '%s-worker' % name}}
+    if policy == 'spread':
+        pod['topologySpreadConstraints'] = [
+            {'maxSkew': 1,
+             'topologyKey': topology_key,
+             'whenUnsatisfiable': ('DoNotSchedule' if mode == 'hard'
+                                   else 'ScheduleAnyway'),
+             'labelSelector': selector}]
+        return
+    term = {'labelSelector': selector, 'topologyKey': topology_key}
+    affinity = pod.setdefault('affinity', {})
+    if mode == 'hard':
+        affinity['podAffinity'] = {
+            'requiredDuringSchedulingIgnoredDuringExecution': [term]}
+    else:
+        affinity['podAffinity'] = {
+            'preferredDuringSchedulingIgnoredDuringExecution': [
+                {'weight': 100, 'podAffinityTerm': term}]}
 
-    template = copy.deepcopy(job['spec']['template'])
 
-    # must remove overriding command and args or we will have trouble
+def worker_template(job):
+    """
+    The MPIJob template for the workers, which must not override the
+    command and args of the worker containers
+    """
+    template = job.template
     if 'spec' in template and 'containers' in template['spec']:
         if template['spec']['containers']:
-            for i in range(len(template['spec']['containers'])):
-                if 'command' in template['spec']['containers'][i]:
-                    del template['spec']['containers'][i]['command']
-                if 'args' in template['spec']['containers'][i]:
-                    del template['spec']['containers'][i]['args']
-
-    logging.debug("mpiset Template: %s", repr(template))
-    target = copy.deepcopy(mpiset['spec']['template'])
-    logging.debug("mpiset Target: %s", repr(target))
-    deep_merge_dicts(target, template)
-    logging.debug("mpiset Update Target: %s", repr(target))
-    mpiset['spec']['template'] = target
-    return mpiset
+            template = replace_path(
+                template, ('spec', 'containers'),
+                [{key: value for key, value in container.items()
+                  if key not in ('command', 'args')}
+                 for container in template['spec']['containers']])
+    return template
+
+
+def elastic(job):
+    """
+    Whether the StatefulSet workers of an MPIJob may start with fewer
+    than replicas
+    """
+    return job.worker_kind == 'StatefulSet' and not job.daemon and \
+        job.min_replicas < job.replicas
+
+
+def new_mpiset(job, replicas=None):
+    """
+    Create the MPI StatefulSet
+    This creates a series of Pods that use an MPI enabled image
+    to build a cluster
+
+    The spec section of the MPIJob definition is used to
+    decorate the container for things like volumes/mounts etc.
+    """
+    if replicas is None:
+        replicas = job.replicas
+    mpiset = mpiset_skeleton(job.name, job.image, replicas, job.configname,
+                             job.daemon, job.ssh_secret, job.placement,
+                             job.shm_size, bool(job.transport))
+
+    template = worker_template(job)
+
+    log_payload("mpiset Template", template)
+    target = mpiset['spec']['template']
+    log_payload("mpiset Target", target)
+    target = timed_call('merge', deep_merge_dicts, target, template)
+    log_payload("mpiset Update Target", target)
+    return replace_path(mpiset, ('spec', 'template'), target)
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def mpidaemonset_skeleton(name, image, configname, ssh_secret=None,
+                          shm_size=None, mca_params_file=False):
+    """
+    The base MPI DaemonSet before the MPIJob template is merged in.
+    This shares the Pod template of the StatefulSet skeleton.
+    The result is shared between calls and must not be modified.
+    """
+    mpiset = mpiset_skeleton(name, image, 0, configname, False, ssh_secret,
+                             None, shm_size, mca_params_file)
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'DaemonSet',
+        'metadata': mpiset['metadata'],
+        'spec': {
+            'revisionHistoryLimit': 10,
+            'selector': mpiset['spec']['selector'],
+            'template': mpiset['spec']['template'],
+            'updateStrategy': {'type': 'RollingUpdate'}
+        }
+    }
 
 
-def configmap_name(job):
+def new_mpidaemonset(job):
     """
-    Generate config map name
+    Create the MPI DaemonSet
+    This runs one worker Pod on each node selected by the nodeSelector,
+    affinity and tolerations of the MPIJob template
     """
-    return'%s-config' % build_name(job)
+    mpiset = mpidaemonset_skeleton(job.name, job.image, job.configname,
+                                   job.ssh_secret, job.shm_size,
+                                   bool(job.transport))
+    target = timed_call('merge', deep_merge_dicts, mpiset['spec']['template'],
+                        worker_template(job))
+    return replace_path(mpiset, ('spec', 'template'), target)
 
 
-def new_mpiserviceaccount(job, name, jobname):
+def new_mpiserviceaccount(job):
     """
     MPI launcher serviceaccount for kubectl access to worker Pods
     """
-    if not name:
-        name = build_name(job)
-    if not jobname:
-        jobname = jobname_name(job)
+    jobname = job.jobname
 
     serviceaccount = {
         'apiVersion': 'v1',
         'kind': 'ServiceAccount',
         'metadata': {
-            'labels': {
-                'group_name': 'skatelescope.org',
-                'mpi_job_name': name,
-                'app': name
-                },
+            'labels': job.labels,
             'name': jobname
             }
         }
     return serviceaccount
 
 
-def new_mpirole(job, name, jobname):
+def new_mpirole(job):
     """
     Create a role so that the launcher can discover worker details
     """
-    if not name:
-        name = build_name(job)
-    if not jobname:
-        jobname = jobname_name(job)
-
-    replicas = int(job['spec']['replicas'] if 'replicas' in job['spec'] else 1)
-    hostfile = ["%s-worker-%d" % (name, i) for i in range(replicas)]
+    name, jobname = job.name, job.jobname
 
-    role = {
-        'apiVersion': 'rbac.authorization.k8s.io/v1',
-        'kind': 'Role',
-        'metadata': {
-            'labels': {
-                'group_name': 'skatelescope.org',
-                'mpi_job_name': name,
-                'app': name
-                },
-            'name': jobname
-            },
-        'rules': [
+    if RBAC_MODE == 'compact' or job.worker_kind == 'DaemonSet':
+        # constant size - any Pod in the namespace
+        rules = [
+            {'apiGroups': [""],
+             'resources': ['pods'],
+             'verbs': ['get', 'list']},
+            {'apiGroups': [""],
+             'resources': ['pods/exec'],
+             'verbs': ['create']}
+            ]
+    else:
+        hostfile = ["%s-worker-%d" % (name, i) for i in range(job.replicas)]
+        rules = [
             {'apiGroups': [""],
              'resourceNames': hostfile,
              'resources': ['pods'],
              'verbs': ['get']},
+            # host discovery lists the workers by label
+            {'apiGroups': [""],
+             'resources': ['pods'],
+             'verbs': ['list']},
             {'apiGroups': [""],
              'resourceNames': hostfile,
              'resources': ['pods/exec'],
              'verbs':['create']}
             ]
+    if job.launch_mode == 'ssh':
+        # ranks are not started through the API server
+        rules = rules[:-1]
+    # the init stage records when it finished on the launcher Job -
+    # kubectl annotate reads the Job before patching it
+    rules = rules + [{'apiGroups': ['batch'],
+                      'resourceNames': ([run_jobname(job, run)
+                                         for run, _ in job.runs]
+                                        or [jobname]),
+                      'resources': ['jobs'],
+                      'verbs': ['get', 'patch']}]
+
+    role = {
+        'apiVersion': 'rbac.authorization.k8s.io/v1',
+        'kind': 'Role',
+        'metadata': {
+            'labels': job.labels,
+            'name': jobname
+            },
+        'rules': rules
         }
     return role
 
 
-def new_mpirolebinding(job, name, jobname):
+def new_mpirolebinding(job):
     """
     Bind the MPI role to the service account
     """
-    if not name:
-        name = build_name(job)
-    if not jobname:
-        jobname = jobname_name(job)
+    jobname = job.jobname
 
     rolebinding = {
         'apiVersion': 'rbac.authorization.k8s.io/v1',
         'kind': 'RoleBinding',
         'metadata': {
-            'labels': {
-                'group_name': 'skatelescope.org',
-                'mpi_job_name': name,
-                'app': name
-                },
+            'labels': job.labels,
             'name': jobname
             },
         'roleRef': {
@@ -312,96 +847,195 @@ def new_mpirolebinding(job, name, jobname):
     return rolebinding
 
 
-def new_configmap(job, name, configname):
+KUBEXEC_SCRIPT = ("#!/bin/sh\n" +
+                  "set -x\n" +
+                  "POD_NAME=$1\n" +
+                  "shift\n" +
+                  "/opt/kube/kubectl exec ${POD_NAME} -- /bin/sh -c \"$*\"\n")
+
+
+def slots_field(slots):
     """
-    Construct the config map that contains the worker Pod details
+    The slots field of a hostfile line - none for slots: auto
+    """
+    return '' if slots == 'auto' else ' slots=%d' % slots
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def daemon_hosts_script(name, slots, address='{.metadata.name}'):
+    """
+    Generate the launcher script that builds the hostfile from the
+    running worker DaemonSet Pods, ordered by node.  The workers are
+    found with a single label selector list call, as how many there are
+    depends on the nodes available.
     """
-    if not name:
-        name = build_name(job)
-    if not configname:
-        configname = configmap_name(job)
+    return ("#!/bin/sh\n" +
+            "set -e\n" +
+            "set -x\n" +
+            "rm -f /etc/mpihosts/hostfile\n" +
+            "/opt/kube/kubectl get pods -l mpi_job_role=" + name +
+            WORKER_SUFFIX + " \\\n" +
+            "  -o jsonpath='{range .items[*]}" + address +
+            " {.status.phase} {.spec.nodeName}{\"\\n\"}{end}' \\\n" +
+            "  > /etc/mpihosts/phases\n" +
+            "sort -s -k3,3 /etc/mpihosts/phases | \\\n" +
+            "  awk '$2 == \"Running\" { print $1 \"" + slots_field(slots) +
+            "\" }' > /etc/mpihosts/hostfile\n" +
+            "echo \"prepared hostfile is:\" \n" +
+            "cat /etc/mpihosts/hostfile\n" +
+            "test -s /etc/mpihosts/hostfile\n")
 
-    replicas = int(job['spec']['replicas'] if 'replicas' in job['spec'] else 1)
-    slots = int(job['spec']['slots'] if 'slots' in job['spec'] else 1)
-    hostfile = "\n".join(["%s-worker-%d slots=%d" % (name, i, slots)
-                          for i in range(replicas)])
 
-    daemon = 'daemon' in job['spec'] and job['spec']['daemon']
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def check_hosts_script(name, slots, daemon, domain='', minimum=0):
+    """
+    Generate the launcher script that filters proposedhosts down to
+    the running worker Pods.  The phases and nodes of all the worker
+    Pods are fetched with a single label selector list call, and the
+    hostfile is ordered by node so that consecutive ranks share a node.
+    With a minimum (elastic jobs) the hostfile takes the workers that
+    are running up to the first one that is not, so that scaling the
+    StatefulSet down to the hostfile keeps every worker in it, and
+    fails if that is fewer than minimum.
+    """
+    return ("#!/bin/sh\n" +
+            "set -e\n" +
+            "set -x\n" +
+            "rm -f /etc/mpihosts/hostfile\n" +
+            "echo \"proposedhosts is:\" \n" +
+            "cat /etc/mpi/proposedhosts \n" +
+            "/opt/kube/kubectl get pods -l mpi_job_role=" + name +
+            WORKER_SUFFIX + " \\\n" +
+            "  -o jsonpath='{range .items[*]}{.metadata.name}" +
+            " {.status.phase} {.spec.nodeName}{\"\\n\"}{end}' \\\n" +
+            "  > /etc/mpihosts/phases\n" +
+            "cut -f1 -d\" \" /etc/mpi/proposedhosts | \\\n" +
+            "awk 'NR == FNR { phase[$1] = $2; node[$1] = $3; next }\n" +
+            ("     phase[$1] != \"Running\" { exit }\n" if minimum else "") +
+            "     { print $1, ($1 in phase) ? phase[$1] : \"Unknown\",\n" +
+            "       node[$1] ? node[$1] : \"-\" }' \\\n" +
+            "  /etc/mpihosts/phases - | sort -s -k3,3" +
+            " > /etc/mpihosts/status\n" +
+            "while read i STATUS NODE\n" +
+            "do\n" +
+            "  echo \"Processing: $i\" \n" +
+            "  echo \"Status is: ${STATUS}\"\n"
+            "  if [ \"${STATUS}\" != \"Running\" ] && " +
+            "  [ \"${STATUS}\" != \"Pending\" ]; then\n" +
+            "    echo \"Bad status - exiting\"\n" +
+            "    exit 1\n" +
+            "  else\n" +
+            "    if [ \"${STATUS}\" = \"Running\" ]; then\n" +
+            "      echo \"$i" + domain + slots_field(slots) +
+            "\" >> /etc/mpihosts/hostfile \n" +
+            "    else\n" +
+            ("      echo \"StatfulSet - must be running - aborting\" \n" +
+             "      exit 1\n" if not daemon else
+             "      echo \"DaemonSet - Ignoring: $i - ${STATUS}\" \n") +
+            "    fi\n" +
+            "  fi\n" +
+            "done < /etc/mpihosts/status\n" +
+            "echo \"prepared hostfile is:\" \n" +
+            "cat /etc/mpihosts/hostfile\n" +
+            ("if [ $(wc -l < /etc/mpihosts/hostfile) -lt %d ]; then\n"
+             "  echo \"Fewer than %d workers running - aborting\"\n"
+             "  exit 1\n"
+             "fi\n" % (minimum, minimum) if minimum else "") +
+            "exit 0\n")
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def mca_params(profile, interface, params=()):
+    """
+    Generate the OpenMPI MCA parameters file for a transport profile,
+    the network interface to use and any extra parameters
+    """
+    values = OrderedDict(MCA_PARAMS_BASE)
+    values.update(TRANSPORT_PROFILES[profile])
+    values['btl_tcp_if_include'] = interface
+    values['oob_tcp_if_include'] = interface
+    values.update(params)
+    return "".join("%s=%s\n" % item for item in values.items())
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def proposed_hosts(name, replicas, slots):
+    """
+    Generate the hostfile listing every worker Pod
+    """
+    return "\n".join(["%s-worker-%d%s" % (name, i, slots_field(slots))
+                      for i in range(replicas)])
 
+
+def new_configmap(job):
+    """
+    Construct the config map that contains the worker Pod details
+    """
+    name = job.name
+    if job.worker_kind == 'DaemonSet':
+        # the workers are only known once they are running
+        proposed = ''
+        check_hosts = daemon_hosts_script(
+            name, job.slots,
+            # DaemonSet Pods have no DNS name to ssh to
+            ('{.status.podIP}' if job.launch_mode == 'ssh'
+             else '{.metadata.name}'))
+    else:
+        proposed = proposed_hosts(name, job.replicas, job.slots)
+        check_hosts = check_hosts_script(
+            name, job.slots, job.daemon,
+            # workers are addressed through the headless Service
+            ('.%s-worker' % name if job.launch_mode == 'ssh' else ''),
+            job.min_replicas if elastic(job) else 0)
     configmap = {
         'apiVersion': 'v1',
-        'data': {'proposedhosts': hostfile,
-                 'kubexec.sh':
-                 "#!/bin/sh\n" +
-                 "set -x\n" +
-                 "POD_NAME=$1\n" +
-                 "shift\n" +
-                 "/opt/kube/kubectl exec ${POD_NAME} -- /bin/sh -c \"$*\"\n",
-                 'check_hosts.sh':
-                 "#!/bin/sh\n" +
-                 "set -e\n" +
-                 "set -x\n" +
-                 "rm -f /etc/mpihosts/hostfile\n" +
-                 "echo \"proposedhosts is:\" \n" +
-                 "cat /etc/mpi/proposedhosts \n" +
-                 "for i in `cat /etc/mpi/proposedhosts | \\\n" +
-                 "cut -f1 -d\" \"` \n" +
-                 "do\n" +
-                 "  echo \"Processing: $i\" \n" +
-                 "  STATUS=`/opt/kube/kubectl get pod $i " +
-                 " -o template --template={{.status.phase}}`\n" +
-                 "  echo \"Status is: ${STATUS}\"\n"
-                 "  if [ \"${STATUS}\" != \"Running\" ] && " +
-                 "  [ \"${STATUS}\" != \"Pending\" ]; then\n" +
-                 "    echo \"Bad status - exiting\"\n" +
-                 "    exit 1\n" +
-                 "  else\n" +
-                 "    if [ \"${STATUS}\" = \"Running\" ]; then\n" +
-                 "      echo \"$i slots=" + str(slots) +
-                 "\" >> /etc/mpihosts/hostfile \n" +
-                 "    else\n" +
-                 ("      echo \"StatfulSet - must be running - aborting\" \n" +
-                  "      exit 1\n" if not daemon else
-                  "      echo \"DaemonSet - Ignoring: $i - ${STATUS}\" \n") +
-                 "    fi\n" +
-                 "  fi\n" +
-                 "done\n" +
-                 "echo \"prepared hostfile is:\" \n" +
-                 "cat /etc/mpihosts/hostfile\n" +
-                 "exit 0\n"},
+        'data': {'proposedhosts': proposed,
+                 'kubexec.sh': KUBEXEC_SCRIPT,
+                 'check_hosts.sh': check_hosts},
         'kind': 'ConfigMap',
         'metadata': {
-            'name': configname
+            'name': job.configname
             }
         }
+    if job.transport:
+        configmap['data'][MCA_PARAMS_FILE] = mca_params(*job.transport)
     return configmap
 
 
-def jobname_name(job):
+def init_command(jobname, deliver='', used_replicas=False):
     """
-    Generate the Job name
+    The shell command for the launcher init stage - deliver kubectl,
+    build the hostfile, then note the time (and for elastic jobs the
+    number of workers in the hostfile) on the launcher Job.  Failing to
+    annotate only loses the timing, so it is logged rather than fatal.
     """
-    return'%s-launcher' % build_name(job)
+    return (deliver +
+            '/etc/mpi/check_hosts.sh && ' +
+            '(/opt/kube/kubectl annotate job ' + jobname + ' --overwrite ' +
+            INIT_FINISHED_ANNOTATION +
+            '=$(date -u +%Y-%m-%dT%H:%M:%SZ)' +
+            (' ' + USED_REPLICAS_ANNOTATION +
+             '=$(wc -l < /etc/mpihosts/hostfile)' if used_replicas else '') +
+            ' || echo "could not annotate job ' + jobname + '" >&2)')
 
 
-def new_mpilauncher(job, name, configname, jobname):  # pylint: too-many-locals
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def mpilauncher_skeleton(name, image, configname, jobname, kubectl_image,
+                         ssh_secret=None, tree_spawn=True,
+                         mca_params_file=False, auto_slots=False,
+                         fast_start=False, kubectl_path=None, run=None,
+                         used_replicas=False):
     """
-    Create the MPI Job
-    This creates a Pod that use an MPI enabled image to run mpiexec or mpirun
-
-    The spec section of the MPIJob definition is used to
-    decorate the container for things like volumes/mounts etc.
+    The base MPI launcher Job before the MPIJob template is merged in.
+    With spec.runs there is one launcher Job for each run, all using the
+    jobname ServiceAccount.
+    The result is shared between calls and must not be modified.
     """
-    if not name:
-        name = build_name(job)
-    if not configname:
-        configname = configmap_name(job)
-    if not jobname:
-        jobname = jobname_name(job)
-    image = MPI_BASE_IMAGE
-    if 'image' in job['spec']:
-        image = job['spec']['image']
-
+    account = jobname
+    if run is not None:
+        jobname = '%s-%s' % (jobname, run)
+    # an image pinned by digest never changes, so skip the registry
+    kubectl_pull = 'IfNotPresent' if '@' in kubectl_image else 'Always'
     mpijob = {
         'apiVersion': 'batch/v1',
         'kind': 'Job',
@@ -452,8 +1086,8 @@ def new_mpilauncher(job, name, configname, jobname):  # pylint: too-many-locals
                         {'name': 'kubectl-delivery',
                          'env': [{'name': 'TARGET_DIR',
                                   'value': '/opt/kube'}],
-                         'image': KUBECTL_IMAGE,
-                         'imagePullPolicy': 'Always',
+                         'image': kubectl_image,
+                         'imagePullPolicy': kubectl_pull,
                          'resources': {},
                          'terminationMessagePath': '/dev/termination-log',
                          'terminationMessagePolicy': 'File',
@@ -467,7 +1101,8 @@ def new_mpilauncher(job, name, configname, jobname):  # pylint: too-many-locals
                          'image': 'busybox:latest',
                          'imagePullPolicy': 'IfNotPresent',
                          'command': ['sh', '-e', '-c',
-                                     '/etc/mpi/check_hosts.sh'],
+                                     init_command(jobname, '',
+                                                  used_replicas)],
                          'volumeMounts': [{'mountPath': '/opt/kube',
                                            'name': 'mpi-job-kubectl'},
                                           {'mountPath': '/etc/mpihosts',
@@ -480,8 +1115,8 @@ def new_mpilauncher(job, name, configname, jobname):  # pylint: too-many-locals
                     'restartPolicy': 'Never',
                     'schedulerName': 'default-scheduler',
                     'securityContext': {},
-                    'serviceAccount': jobname,
-                    'serviceAccountName': jobname,
+                    'serviceAccount': account,
+                    'serviceAccountName': account,
                     'terminationGracePeriodSeconds': 30,
                     'volumes': [
                         {'emptyDir': {},
@@ -507,16 +1142,86 @@ def new_mpilauncher(job, name, configname, jobname):  # pylint: too-many-locals
                 }
             }
         }
-    template = copy.deepcopy(job['spec']['template'])
-    logging.debug("mpijob Template: %s", repr(template))
-    target = copy.deepcopy(mpijob['spec']['template'])
-    logging.debug("mpijob Target: %s", repr(target))
-    deep_merge_dicts(target, template)
-    logging.debug("mpijob Update Target: %s", repr(target))
-    mpijob['spec']['template'] = target
+    if ssh_secret:
+        # start ranks with ssh straight to the workers
+        pod = mpijob['spec']['template']['spec']
+        container = pod['containers'][0]
+        container['env'] = [
+            {'name': 'OMPI_MCA_plm_rsh_agent',
+             'value': 'ssh'},
+            {'name': 'OMPI_MCA_plm_rsh_args',
+             'value': SSH_ARGS},
+            {'name': 'OMPI_MCA_plm_rsh_no_tree_spawn',
+             'value': '0' if tree_spawn else '1'},
+            {'name': 'OMPI_MCA_orte_default_hostfile',
+             'value': '/etc/mpihosts/hostfile'}]
+        container['volumeMounts'].append(SSH_VOLUME_MOUNT)
+        pod['volumes'].append(ssh_volume(ssh_secret))
+    if auto_slots:
+        # hosts without a slots count get one slot per core
+        mpijob['spec']['template']['spec']['containers'][0]['env'].append(
+            {'name': 'OMPI_MCA_orte_set_default_slots',
+             'value': 'cores'})
+    if fast_start:
+        # one init stage: kubectl from the MPI image (no extra pull) or
+        # from the delivery image, then the host check
+        pod = mpijob['spec']['template']['spec']
+        init = pod['initContainers'][0]
+        init['name'] = 'prepare-launcher'
+        init['command'] = ['sh', '-e', '-c', init_command(
+            jobname, 'cp %s /opt/kube/kubectl && ' %
+            (kubectl_path or '/bin/kubectl'), used_replicas)]
+        init['volumeMounts'] = pod['initContainers'][1]['volumeMounts']
+        if kubectl_path:
+            init['image'] = image
+            init['imagePullPolicy'] = 'IfNotPresent'
+        del pod['initContainers'][1:]
+    pod_tuning(mpijob['spec']['template']['spec'],
+               mca_params_file=mca_params_file)
     return mpijob
 
 
+def run_jobname(job, run):
+    """
+    Generate the launcher Job name for one of spec.runs
+    """
+    return '%s-%s' % (job.jobname, run)
+
+
+def new_mpilauncher(job, run=None, override=None):
+    """
+    Create the MPI Job
+    This creates a Pod that use an MPI enabled image to run mpiexec or mpirun
+
+    The spec section of the MPIJob definition is used to
+    decorate the container for things like volumes/mounts etc.
+    For one of spec.runs, the command, args and env of the run are then
+    merged into the launcher container.
+    """
+    mpijob = mpilauncher_skeleton(job.name, job.image, job.configname,
+                                  job.jobname, KUBECTL_IMAGE, job.ssh_secret,
+                                  job.tree_spawn, bool(job.transport),
+                                  job.slots == 'auto', job.fast_start,
+                                  job.kubectl_path, run, elastic(job))
+    template = job.template
+    log_payload("mpijob Template", template)
+    target = mpijob['spec']['template']
+    log_payload("mpijob Target", target)
+    target = timed_call('merge', deep_merge_dicts, target, template)
+    if override:
+        # command and args replace the template, env is merged by name
+        containers = list(target['spec']['containers'])
+        container = dict(containers[0], **override)
+        names = set(env.get('name') for env in override.get('env', []))
+        container['env'] = [env for env in containers[0].get('env', [])
+                            if env.get('name') not in names] + \
+            override.get('env', [])
+        containers[0] = container
+        target = replace_path(target, ('spec', 'containers'), containers)
+    log_payload("mpijob Update Target", target)
+    return replace_path(mpijob, ('spec', 'template'), target)
+
+
 def parse_config(children):
     """
     See if we have a configured/named config
@@ -529,93 +1234,1690 @@ def parse_config(children):
 
 def parse_job(children):
     """
-    parse status information out of the Job element
+    parse status information out of the Job elements.  With several
+    launcher Jobs (spec.runs) the job is Running until all of them have
+    finished, and only succeeded if they all did.
+    """
+    runs = OrderedDict(
+        (mpijob_name, parse_launcher(mpijob_name, mpijob))
+        for mpijob_name, mpijob in
+        sorted(children['Job.batch/v1'].items()))
+    if len(runs) <= 1:
+        # a copy - the entry in runs must not contain runs itself
+        job_status = dict(next(iter(runs.values())) if runs
+                          else parse_launcher(False, {}))
+        job_status['runs'] = runs
+        return job_status
+
+    states = list(runs.values())
+    job_status = parse_launcher(states[0]['name'], {})
+    job_status['runs'] = runs
+    job_status['started'] = min(
+        [state['started'] for state in states
+         if state['started'] is not None] or [None])
+    job_status['usedReplicas'] = min(
+        [state['usedReplicas'] for state in states
+         if state['usedReplicas'] is not None] or [None])
+    if all(state['state'] == 'Finished' for state in states):
+        failed = [state for state in states
+                  if state['succeeded'] != 'succeeded']
+        job_status['state'] = 'Finished'
+        job_status['succeeded'] = 'Failed' if failed else 'succeeded'
+        job_status['status'] = 'Failed' if failed else 'Complete'
+        job_status['finished'] = max(
+            [state['finished'] for state in states
+             if state['finished'] is not None] or [None])
+    elif any(state['state'] for state in states):
+        job_status['state'] = 'Running'
+        job_status['succeeded'] = 'Unknown'
+        job_status['status'] = 'Unknown'
+    return job_status
+
+
+def parse_launcher(mpijob_name, mpijob):
+    """
+    parse status information out of one launcher Job
     """
-    job_status = {'name': False,
+    job_status = {'name': mpijob_name,
                   'state': "",
                   'status': "",
-                  'succeeded': ""}
-    for mpijob_name, mpijob in children['Job.batch/v1'].items():
-        job_status['name'] = mpijob_name
-        if mpijob.get('status', {}).get('active', 0) == 1:
+                  'succeeded': "",
+                  'finished': None,
+                  'started': None,
+                  'initSeconds': None,
+                  'usedReplicas': None}
+    if mpijob:
+        started = job_status['started'] = parse_time(
+            mpijob.get('status', {}).get('startTime'))
+        initialised = parse_time(mpijob.get('metadata', {}).get(
+            'annotations', {}).get(INIT_FINISHED_ANNOTATION))
+        if started is not None and initialised is not None:
+            job_status['initSeconds'] = max(initialised - started, 0)
+        used = mpijob.get('metadata', {}).get('annotations', {}).get(
+            USED_REPLICAS_ANNOTATION, '')
+        if used.strip().isdigit() and int(used) > 0:
+            job_status['usedReplicas'] = int(used)
+    if mpijob.get('status', {}).get('active', 0) == 1:
+        job_status['state'] = 'Running'
+        job_status['succeeded'] = 'Unknown'
+        job_status['status'] = 'Unknown'
+    for condition in mpijob.get('status', {}).get('conditions', []):
+        if (condition['type'] == 'Complete' or
+                condition['type'] == 'Failed') and \
+           condition['status'] == 'True':
+            job_status['state'] = 'Finished'
+            job_status['succeeded'] = \
+                ("succeeded" if
+                 mpijob.get('status', {}).get('succeeded', 0) == 1
+                 else "Failed")
+            job_status['finished'] = parse_time(
+                mpijob.get('status', {}).get('completionTime') or
+                condition.get('lastTransitionTime'))
+        else:
             job_status['state'] = 'Running'
             job_status['succeeded'] = 'Unknown'
-            job_status['status'] = 'Unknown'
-        for condition in mpijob.get('status', {}).get('conditions', []):
-            if (condition['type'] == 'Complete' or
-                    condition['type'] == 'Failed') and \
-               condition['status'] == 'True':
-                job_status['state'] = 'Finished'
-                job_status['succeeded'] = \
-                    ("succeeded" if
-                     mpijob.get('status', {}).get('succeeded', 0) == 1
-                     else "Failed")
-            else:
-                job_status['state'] = 'Running'
-                job_status['succeeded'] = 'Unknown'
-            job_status['status'] = condition['type']
+        job_status['status'] = condition['type']
     return job_status
 
 
-class Controller(BaseHTTPRequestHandler):
+def read_body(rfile, length):
     """
-    Basic HHTP controller - handles only POST requests
+    Read length bytes of request body into this thread's reusable buffer
     """
-    def sync(self, job, children):  # pylint: disable=no-self-use
-        """
-        Synchronise the incoming MPIJob request by generating
-        Kubernetes object specifications
-        """
-        logging.debug("Job in: %s", repr(job))
-        logging.debug("Children in: %s", repr(children))
+    buf = getattr(BUFFERS, 'body', None)
+    if buf is None or len(buf) < length:
+        buf = BUFFERS.body = bytearray(max(length, 65536))
+    view = memoryview(buf)[:length]
+    received = 0
+    while received < length:
+        count = rfile.readinto(view[received:])
+        if not count:
+            raise EOFError("request body truncated at %d of %d bytes" %
+                           (received, length))
+        received += count
+    return view
 
-        configname = parse_config(children)
-        job_status = parse_job(children)
 
-        desired_status = {
-            'currentReplicas': 0,
-            'readyReplicas': 0,
-            'replicas': 0,
-            'job': {}
-            }
+def accepts_gzip(accept_encoding):
+    """
+    Check an Accept-Encoding header for gzip
+    """
+    for coding in (accept_encoding or '').split(','):
+        params = coding.strip().split(';')
+        if params[0].strip().lower() not in ('gzip', '*'):
+            continue
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q' and value.strip() in ('0', '0.0', '0.00', '0.000'):
+                return False
+        return True
+    return False
 
-        name = False
-        for mpiset_name, mpiset in children['StatefulSet.apps/v1'].items():
-            if mpiset_name.endswith(WORKER_SUFFIX):
-                name = mpiset_name[:-len(WORKER_SUFFIX)]
-            desired_status['currentReplicas'] = \
-                mpiset.get('status', {}).get('currentReplicas')
-            desired_status['readyReplicas'] = \
-                mpiset.get('status', {}).get('readyReplicas')
-            desired_status['replicas'] = \
-                mpiset.get('status', {}).get('replicas')
-        desired_status['job'] = {'state': job_status['state'],
-                                 'status': job_status['status'],
-                                 'success': job_status['succeeded']}
 
-        return {'status': desired_status, 'children':
-                [new_mpiserviceaccount(job, name, job_status['name']),
-                 new_mpirole(job, name, job_status['name']),
-                 new_mpirolebinding(job, name, job_status['name']),
-                 new_configmap(job, name, configname),
-                 new_mpiset(job, name),
-                 new_mpilauncher(job, name, configname, job_status['name'])]}
+def parse_time(stamp):
+    """
+    Convert a Kubernetes timestamp to seconds since the epoch, or None
+    """
+    try:
+        return calendar.timegm(time.strptime(stamp, '%Y-%m-%dT%H:%M:%SZ'))
+    except (TypeError, ValueError):
+        return None
 
-# we only handle POST requests
-    def do_POST(self):  # pylint: disable=invalid-name
-        """
-        the POST responder...
-        """
-        observed = json.loads(self.rfile.read(
-            int(self.headers.get('content-length'))))
-        desired = self.sync(observed['parent'], observed['children'])
 
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        logging.debug("out: %s", str(json.dumps(desired)))
-        self.wfile.write(json.dumps(desired).encode())
+def format_time(epoch):
+    """
+    Convert seconds since the epoch to a Kubernetes timestamp
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+def required_workers(job, scheduled=0):
+    """
+    How many workers must be ready before the launcher can start
+    """
+    if job.worker_kind == 'DaemonSet':
+        return max(scheduled or 0, 1)
+    return 1 if job.daemon else job.min_replicas
+
+
+def launch_gate(job, job_status, ready_replicas, now, scheduled=0,
+                since=None):
+    """
+    Decide whether the launcher Job can be created.
+    The launcher is withheld until the worker StatefulSet reports all
+    replicas (minReplicas when elastic) ready (one for daemon mode,
+    where workers that cannot be placed are skipped), or the worker
+    DaemonSet reports all of its scheduled Pods ready, unless it
+    already exists.
+    The timeout runs from since, when the job was admitted, or from
+    its creation, and once reported it stands even if the workers
+    become ready later.
+    Returns (launch, timed_out, seconds left before the timeout or None)
+    """
+    if job_status['name'] or not job.wait_for_workers:
+        return True, False, None
+
+    if job.status.get('job', {}).get('status') == 'WorkersTimeout':
+        return False, True, 0
+
+    if (ready_replicas or 0) >= required_workers(job, scheduled):
+        return True, False, None
+
+    since = since or job.created
+    if not job.workers_timeout or since is None:
+        return False, False, None
+    remaining = since + job.workers_timeout - now
+    return False, remaining <= 0, max(remaining, 0)
+
+
+def release_gate(job, finished, finished_at, now):
+    """
+    Decide whether the workers of a finished MPIJob can be released.
+    Returns (release, seconds left before release or None)
+    """
+    if not finished or job.cleanup_policy == 'None':
+        return False, None
+    if job.ttl_after_finished <= 0:
+        return True, None
+    if finished_at is None:
+        return False, None
+    remaining = finished_at + job.ttl_after_finished - now
+    return remaining <= 0, max(remaining, 0)
+
+
+def lifecycle(job, events, now):
+    """
+    Add the lifecycle events that have happened to the timestamps in the
+    MPIJob status.  events is a sequence of (name, when) where when is
+    the time of the event, True if it has happened at an unknown time
+    (taken as now) or None if it has not happened.  Timestamps already
+    in the status are kept.
+    Returns (timestamps, durations in seconds)
+    """
+    timestamps = dict(job.status.get('timestamps') or {})
+    for event, when in events:
+        if event not in timestamps and when:
+            timestamps[event] = format_time(now if when is True else when)
+    durations = {}
+    for duration, start, end in LIFECYCLE_DURATIONS:
+        began = parse_time(timestamps.get(start))
+        ended = parse_time(timestamps.get(end))
+        if began is not None and ended is not None:
+            durations[duration] = max(ended - began, 0)
+    return timestamps, durations
+
+
+def resync_after(phase):
+    """
+    Seconds until the MetaController should sync an MPIJob in phase
+    again, or None to leave it to the MetaController
+    """
+    interval = RESYNC_INTERVALS.get(RESYNC_PHASES.get(phase, 'running'))
+    if not interval:
+        return None
+    jitter = interval * RESYNC_JITTER
+    return max(1, int(round(interval + random.uniform(-jitter, jitter))))
+
+
+def parse_intervals(value):
+    """
+    argparse type for phase=seconds,... resync intervals
+    """
+    intervals = dict(RESYNC_INTERVALS)
+    for item in value.split(','):
+        phase, _, seconds = item.partition('=')
+        if phase.strip() not in RESYNC_INTERVALS:
+            raise argparse.ArgumentTypeError(
+                "unknown phase '%s', expected one of: %s" %
+                (phase, ', '.join(sorted(RESYNC_INTERVALS))))
+        try:
+            intervals[phase.strip()] = float(seconds)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "bad interval for %s: '%s'" % (phase, seconds))
+    return intervals
+
+
+def sync_key(job, children, *plan):
+    """
+    Generate the cache key for the children rendered by sync.
+    This is the parent UID and generation, plus a digest of the observed
+    child fields that sync reads and the plan decided from them.
+    None means the request is not cacheable.
+    """
+    if job.uid is None or job.generation is None:
+        return None
+    observed = {
+        'configmaps': sorted(children.get('ConfigMap.v1', {})),
+        'statefulsets': sorted(
+            (mpiset_name,
+             mpiset.get('status', {}).get('currentReplicas'),
+             mpiset.get('status', {}).get('readyReplicas'),
+             mpiset.get('status', {}).get('replicas'))
+            for mpiset_name, mpiset in
+            children.get('StatefulSet.apps/v1', {}).items()),
+        'daemonsets': sorted(
+            (mpiset_name,
+             mpiset.get('status', {}).get('currentNumberScheduled'),
+             mpiset.get('status', {}).get('numberReady'),
+             mpiset.get('status', {}).get('desiredNumberScheduled'))
+            for mpiset_name, mpiset in
+            children.get('DaemonSet.apps/v1', {}).items()),
+        'jobs': sorted(
+            (mpijob_name,
+             mpijob.get('status', {}).get('active', 0),
+             mpijob.get('status', {}).get('succeeded', 0),
+             [(condition.get('type'), condition.get('status'))
+              for condition in mpijob.get('status', {}).get('conditions',
+                                                             [])])
+            for mpijob_name, mpijob in
+            children.get('Job.batch/v1', {}).items()),
+        'plan': plan}
+    digest = hashlib.sha1(json.dumps(observed, sort_keys=True).encode())
+    return (job.uid, job.generation, digest.hexdigest())
+
+
+class SyncCache(object):
+    """
+    Bounded LRU cache with TTL of the children rendered by sync
+    """
+    def __init__(self, maxsize=1024, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None
+        """
+        if key is None or self.maxsize <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache value under key, evicting the least recently used entries
+        """
+        if key is None or self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Cache counters
+        """
+        with self.lock:
+            return {'size': len(self.entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+SYNC_CACHE = SyncCache()
+
+
+class AdmissionLedger(object):
+    """
+    Worker slots (replicas x slots) held by admitted MPIJobs against a
+    capacity, for the whole cluster or per namespace.  Jobs that do not
+    fit wait in order of priority then age, and are admitted strictly
+    in that order so that large jobs are not starved.
+
+    The ledger is in memory and rebuilt from the MPIJobs as they are
+    synced - jobs with workers or marked admitted in their status are
+    re-admitted - and no new jobs are admitted for warmup seconds after
+    start while that happens.  It needs a single controller replica.
+    """
+    def __init__(self, capacity=0, per_namespace=False, warmup=0.0,
+                 stale=600.0):
+        self.capacity = capacity
+        self.per_namespace = per_namespace
+        self.warmup = warmup
+        self.stale = stale
+        self.started = time.monotonic()
+        # uid -> [scope, order, demand, admitted, last seen]
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def admit(self, job, demand, admitted=False):
+        """
+        Record an MPIJob needing demand slots and decide whether it may
+        have workers.  admitted is True for a job that already has them.
+        Returns (admitted, position in the queue or None)
+        """
+        if self.capacity <= 0 or job.uid is None:
+            return True, None
+        now = time.monotonic()
+        scope = job.namespace if self.per_namespace else ''
+        order = (-job.priority, job.created or 0, job.uid)
+        with self.lock:
+            self.prune(now)
+            entry = self.jobs.setdefault(job.uid, [scope, order, demand,
+                                                   admitted, now])
+            entry[1:] = [order, demand, entry[3] or admitted, now]
+            if entry[3]:
+                return True, None
+            # jobs that can never fit must not hold up the queue
+            waiting = sorted((other for other in self.jobs.values()
+                              if other[0] == scope and not other[3] and
+                              other[2] <= self.capacity),
+                             key=lambda other: other[1])
+            if entry not in waiting:
+                return False, None
+            if now - self.started < self.warmup:
+                return False, waiting.index(entry)
+            used = sum(other[2] for other in self.jobs.values()
+                       if other[0] == scope and other[3])
+            for other in waiting:
+                used += other[2]
+                if used > self.capacity:
+                    break
+                if other is entry:
+                    entry[3] = True
+                    return True, None
+            return False, waiting.index(entry)
+
+    def release(self, uid):
+        """
+        Give back the slots of an MPIJob that has finished or gone
+        """
+        with self.lock:
+            self.jobs.pop(uid, None)
+
+    def prune(self, now):
+        """
+        Forget jobs that have not been synced for stale seconds
+        """
+        for uid in [uid for uid, entry in self.jobs.items()
+                    if now - entry[4] > self.stale]:
+            del self.jobs[uid]
+
+    def stats(self):
+        """
+        Ledger totals for each scope
+        """
+        with self.lock:
+            scopes = {}
+            for scope, _, demand, admitted, _ in self.jobs.values():
+                totals = scopes.setdefault(scope, {'capacity': self.capacity,
+                                                   'used': 0, 'queued': 0,
+                                                   'queuedSlots': 0})
+                if admitted:
+                    totals['used'] += demand
+                else:
+                    totals['queued'] += 1
+                    totals['queuedSlots'] += demand
+            return scopes
+
+
+ADMISSION = AdmissionLedger()
+
+
+def job_demand(job, replicas=None):
+    """
+    Worker slots an MPIJob holds - DaemonSet workers are not counted
+    as their number depends on the nodes, and slots: auto counts as one.
+    replicas is the number of workers an elastic job was scaled down to.
+    """
+    if job.worker_kind == 'DaemonSet':
+        return 0
+    return (replicas or job.replicas) * (1 if job.slots == 'auto'
+                                         else job.slots)
+
+
+class Metric(object):
+    """
+    Base Prometheus metric - values keyed on a tuple of label values
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels(self, labelvalues, extra=()):
+        """
+        Format a label set
+        """
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs)
+
+    def samples(self):
+        """
+        Yield (suffix, labels, value) for each sample
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        for labelvalues, value in values:
+            yield '', self.labels(labelvalues), value
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, *labelvalues):
+        """
+        Add amount
+        """
+        with self.lock:
+            self.values[labelvalues] = \
+                self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down
+    """
+    kind = 'gauge'
+
+    def set(self, value, *labelvalues):
+        """
+        Set the value
+        """
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """
+    Observations counted into cumulative buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        """
+        Record an observation
+        """
+        with self.lock:
+            counts = self.values.get(labelvalues)
+            if counts is None:
+                # per bucket counts, then +Inf count and sum
+                counts = self.values[labelvalues] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labelvalues, list(counts))
+                            for labelvalues, counts in self.values.items())
+        for labelvalues, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                yield ('_bucket',
+                       self.labels(labelvalues, [('le', repr(float(bound)))]),
+                       count)
+            yield '_bucket', self.labels(labelvalues, [('le', '+Inf')]), \
+                counts[-2]
+            yield '_count', self.labels(labelvalues), counts[-2]
+            yield '_sum', self.labels(labelvalues), counts[-1]
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(9))
+
+SYNC_REQUESTS = Counter('mpi_sync_requests_total',
+                        'Sync hook requests by HTTP status code', ['code'])
+SYNC_IN_FLIGHT = Gauge('mpi_sync_requests_in_flight',
+                       'Sync hook requests being served')
+SYNC_REQUEST_BYTES = Histogram('mpi_sync_request_bytes',
+                               'Sync hook request body size', SIZE_BUCKETS)
+SYNC_RESPONSE_BYTES = Histogram('mpi_sync_response_bytes',
+                                'Sync hook response body size before '
+                                'compression', SIZE_BUCKETS)
+SYNC_SECONDS = Histogram('mpi_sync_request_duration_seconds',
+                         'Sync hook request latency', LATENCY_BUCKETS)
+SYNC_STAGE_SECONDS = Histogram('mpi_sync_stage_duration_seconds',
+                               'Time spent in each stage of a sync',
+                               LATENCY_BUCKETS, ['stage'])
+MPI_JOBS = Gauge('mpi_jobs', 'MPIJobs by the last job state reported '
+                 'by sync', ['state', 'success'])
+CACHE_EVENTS = Counter('mpi_sync_cache_events_total',
+                       'Sync result cache hits, misses, evictions and '
+                       'expirations', ['event'])
+CACHE_SIZE = Gauge('mpi_sync_cache_entries', 'Sync results cached')
+JOB_COMPLETIONS = Counter('mpi_job_completions_total',
+                          'MPIJobs seen to finish, by outcome', ['success'])
+
+# last job state seen for each MPIJob UID, with when it was seen
+JOB_STATES = {}
+JOB_STATES_LOCK = threading.Lock()
+# seconds without a sync before an MPIJob is taken to be gone - deleted
+# MPIJobs are only reported to finalize when admission is enabled, and
+# finished ones are not resynced by default, so they are kept longer
+JOB_STATES_STALE = 600.0
+JOB_STATES_FINISHED_STALE = 86400.0
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """
+    Time the enclosed block as a sync stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SYNC_STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+
+
+def timed_call(stage, func, *args):
+    """
+    Call func, timing it as a sync stage
+    """
+    with timed_stage(stage):
+        return func(*args)
+
+
+def record_job_state(job, job_state):
+    """
+    Remember the job state of an MPIJob for the mpi_jobs gauge
+    """
+    if job.uid is None:
+        return
+    labelvalues = (job_state['state'] or 'Pending',
+                   job_state['success'] or 'Unknown')
+    with JOB_STATES_LOCK:
+        previous = JOB_STATES.get(job.uid)
+        JOB_STATES[job.uid] = (labelvalues, time.time())
+    # count a job when it is seen to finish - not the finished jobs that
+    # are synced again after a restart
+    if labelvalues[0] == 'Finished' and previous is not None and \
+       previous[0][0] != 'Finished':
+        JOB_COMPLETIONS.inc(1, labelvalues[1])
+
+
+def observed_workers(children):
+    """
+    Find the worker StatefulSet or DaemonSet among the observed children.
+    Returns (MPIJob name or False, the worker counts for the status)
+    """
+    name = False
+    counts = {'currentReplicas': 0, 'readyReplicas': 0, 'replicas': 0}
+    for kind, fields in WORKER_STATUS_FIELDS:
+        for mpiset_name, mpiset in children.get(kind, {}).items():
+            if mpiset_name.endswith(WORKER_SUFFIX):
+                name = mpiset_name[:-len(WORKER_SUFFIX)]
+            status = mpiset.get('status', {})
+            counts = {count: status.get(field)
+                      for count, field in zip(WORKER_COUNTS, fields)}
+    return name, counts
+
+
+def plan_runs(job, job_status):
+    """
+    Decide which of spec.runs have a launcher Job - those already
+    started and the next ones up to runConcurrency at once.
+    Returns (runs to render, the status of each run, whether any run
+    is still to start)
+    """
+    pending = [(run, override) for run, override in job.runs
+               if run_jobname(job, run) not in job_status['runs']]
+    active = sum(1 for state in job_status['runs'].values()
+                 if state['state'] != 'Finished')
+    starting = pending[:max(job.run_concurrency - active, 0)]
+    runs = [(run, override) for run, override in job.runs
+            if run_jobname(job, run) in job_status['runs'] or
+            (run, override) in starting]
+    statuses = []
+    for run, _ in job.runs:
+        state = job_status['runs'].get(run_jobname(job, run), {})
+        statuses.append({'name': run,
+                         'job': run_jobname(job, run),
+                         'state': state.get('state') or 'Pending',
+                         'status': state.get('status') or '',
+                         'success': state.get('succeeded') or ''})
+    return runs, statuses, bool(pending)
+
+
+def admission_status(job, demand, has_workers):
+    """
+    Ask the admission ledger whether an MPIJob may have its workers.
+    Jobs whose workers were released have already left the ledger.
+    Returns the admission status
+    """
+    admitted, position = True, None
+    if job.status.get('workers') != 'Released':
+        admitted, position = ADMISSION.admit(
+            job, demand,
+            bool(has_workers or
+                 job.status.get('admission', {}).get('admitted')))
+    status = {'admitted': admitted, 'slots': demand}
+    if not admitted:
+        status['position'] = position
+        if position is None:
+            status['reason'] = 'ExceedsCapacity'
+    return status
+
+
+def admitted_time(job, now):
+    """
+    When an admitted MPIJob was admitted
+    """
+    if ADMISSION.capacity > 0:
+        return parse_time(job.status.get('timestamps', {}).get(
+            'admitted')) or now
+    # without admission every job is admitted when it is created
+    return job.created
+
+
+def resync_within(resync, remaining):
+    """
+    Bring the resync forward so that a deadline remaining seconds away
+    is noticed
+    """
+    deadline = int(remaining) + 1
+    return deadline if resync is None else min(resync, deadline)
+
+
+def worker_gates(job, job_status, desired_status, admitted_at, now):
+    """
+    Apply the gang start and release gates, updating the phase, job
+    state and workers in desired_status.
+    Returns (launch, release, when the job finished or None, seconds
+    until the next resync or None)
+    """
+    # gang start - no launcher until the workers are ready
+    launch, timed_out, remaining = launch_gate(
+        job, job_status, desired_status['readyReplicas'], now,
+        desired_status['replicas'], admitted_at)
+    if timed_out:
+        desired_status['phase'] = 'Failed'
+        desired_status['job'] = {'state': 'Finished',
+                                 'status': 'WorkersTimeout',
+                                 'success': 'Failed'}
+    elif not launch:
+        desired_status['phase'] = 'WaitingForWorkers'
+
+    # resync sooner while things are changing
+    resync = resync_after(desired_status['phase'])
+    if remaining is not None and not timed_out:
+        # make sure the timeout is noticed
+        resync = resync_within(resync, remaining)
+
+    # give back the workers once the job is done
+    finished_at = job_status['finished']
+    if timed_out and admitted_at is not None:
+        finished_at = admitted_at + (job.workers_timeout or 0)
+    release, remaining = release_gate(
+        job, desired_status['job']['state'] == 'Finished', finished_at, now)
+    if release:
+        desired_status['workers'] = 'Released'
+    elif remaining is not None:
+        resync = resync_within(resync, remaining)
+    return launch, release, finished_at, resync
+
+
+def lifecycle_events(job, job_status, desired_status, admitted_at,
+                     finished_at):
+    """
+    The lifecycle events of an admitted MPIJob, for lifecycle()
+    """
+    required = required_workers(job, desired_status['replicas'])
+    finished = desired_status['job']['state'] == 'Finished'
+    return (('created', job.created),
+            ('admitted', admitted_at or True),
+            ('workersScheduled',
+             (desired_status['currentReplicas'] or 0) >= required),
+            ('workersReady',
+             (desired_status['readyReplicas'] or 0) >= required),
+            ('launcherStarted', job_status['started']),
+            ('completed', (finished_at or True) if finished else None))
+
+
+def render_children(job, children, runs, *plan):
+    """
+    Generate the children of an MPIJob for plan (launch, release, used
+    replicas).  Periodic resyncs of unchanged jobs render identical
+    children, so these come from the sync cache when they can.
+    """
+    launch, release, used = plan
+    key = sync_key(job, children, *plan)
+    rendered = SYNC_CACHE.get(key)
+    if rendered is not None:
+        logging.debug("cache hit: %r", key)
+        return rendered
+
+    cleanup_all = release and job.cleanup_policy == 'All'
+    rendered = [timed_call('new_mpiserviceaccount',
+                           new_mpiserviceaccount, job)]
+    if not cleanup_all:
+        rendered += [
+            timed_call('new_mpirole', new_mpirole, job),
+            timed_call('new_mpirolebinding', new_mpirolebinding, job),
+            timed_call('new_configmap', new_configmap, job)]
+    if job.worker_kind == 'DaemonSet':
+        # a DaemonSet cannot be scaled down, only removed
+        if not release:
+            rendered.append(timed_call('new_mpidaemonset',
+                                       new_mpidaemonset, job))
+    else:
+        rendered.append(timed_call('new_mpiset', new_mpiset, job,
+                                   0 if release else used))
+    if job.launch_mode == 'ssh' and not cleanup_all and \
+       job.worker_kind == 'StatefulSet':
+        rendered.append(timed_call('new_mpiservice', new_mpiservice, job))
+    if launch and job.runs:
+        rendered += [timed_call('new_mpilauncher', new_mpilauncher,
+                                job, run, override)
+                     for run, override in runs]
+    elif launch:
+        rendered.append(timed_call('new_mpilauncher', new_mpilauncher, job))
+    SYNC_CACHE.put(key, rendered)
+    return rendered
+
+
+def sync_response(status, children, resync):
+    """
+    The sync response for the MetaController
+    """
+    desired = {'status': status, 'children': children}
+    if resync is not None:
+        desired['resyncAfterSeconds'] = resync
+    return desired
+
+
+def render_metrics():
+    """
+    Render every metric in the Prometheus text exposition format
+    """
+    now = time.time()
+    with JOB_STATES_LOCK:
+        for uid in [uid for uid, (labelvalues, seen) in JOB_STATES.items()
+                    if now - seen > (JOB_STATES_FINISHED_STALE
+                                     if labelvalues[0] == 'Finished'
+                                     else JOB_STATES_STALE)]:
+            del JOB_STATES[uid]
+        counts = {}
+        for labelvalues, _ in JOB_STATES.values():
+            counts[labelvalues] = counts.get(labelvalues, 0) + 1
+    with MPI_JOBS.lock:
+        MPI_JOBS.values = counts
+    stats = SYNC_CACHE.stats()
+    for event in ('hits', 'misses', 'evictions', 'expirations'):
+        with CACHE_EVENTS.lock:
+            CACHE_EVENTS.values[(event,)] = stats[event]
+    CACHE_SIZE.set(stats['size'])
+    return '\n'.join(
+        metric.render() for metric in (
+            SYNC_REQUESTS, SYNC_IN_FLIGHT, SYNC_REQUEST_BYTES,
+            SYNC_RESPONSE_BYTES, SYNC_SECONDS, SYNC_STAGE_SECONDS,
+            MPI_JOBS, JOB_COMPLETIONS, CACHE_EVENTS, CACHE_SIZE)) + '\n'
+
+
+class Payload(object):
+    """
+    A document to log, only encoded (and cut to PAYLOAD_LOG_BYTES) when
+    the log message is formatted
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            try:
+                value = JSON_DUMPS(value)
+            except TypeError:
+                value = repr(value).encode()
+        if 0 < PAYLOAD_LOG_BYTES < len(value):
+            return '%s... (%d bytes)' % (
+                bytes(value[:PAYLOAD_LOG_BYTES]).decode('utf-8', 'replace'),
+                len(value))
+        return bytes(value).decode('utf-8', 'replace')
+
+
+def sample_payloads():
+    """
+    Decide whether the payloads of the request on this thread are logged
+    """
+    PAYLOAD_LOG.sampled = (
+        PAYLOAD_LOG_EVERY > 0 and
+        logging.getLogger().isEnabledFor(logging.DEBUG) and
+        random.random() * PAYLOAD_LOG_EVERY < 1)
+
+
+def log_payload(label, value):
+    """
+    Log a document at DEBUG if the payloads of this request are sampled
+    """
+    if getattr(PAYLOAD_LOG, 'sampled', False):
+        logging.debug("%s: %s", label, Payload(value))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format each log record as a single line JSON document
+    """
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return JSON_DUMPS(entry).decode()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue log records unformatted, so that the message is built by the
+    listener thread rather than the request thread.  This relies on log
+    arguments not being modified once logged, which holds for the
+    documents sync builds as they are never modified once built.
+    """
+    def prepare(self, record):
+        if record.exc_info:
+            # a traceback holds on to its frames - format it now
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(level='INFO', fmt='text'):
+    """
+    Log through a queue to a listener thread that formats the records
+    and writes them to stderr.  Returns the started listener.
+    """
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if fmt == 'json'
+                        else logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+class Profiler(object):
+    """
+    cProfile of sync calls for a bounded window - until the deadline or
+    until requests calls have been profiled.  The profiler hooks are per
+    interpreter, so only one call is profiled at a time and concurrent
+    calls run unprofiled: the result is a sample of the syncs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiling = threading.Lock()
+        self.stats = None
+        self.deadline = 0
+        self.remaining = 0
+        self.profiled = 0
+        self.skipped = 0
+
+    def start(self, seconds, requests):
+        """
+        Throw away the last profile and profile the next syncs
+        """
+        with self.lock:
+            self.stats = None
+            self.deadline = time.monotonic() + seconds
+            self.remaining = requests
+            self.profiled = self.skipped = 0
+
+    def stop(self):
+        """
+        Stop profiling, keeping the profile
+        """
+        with self.lock:
+            self.remaining = 0
+
+    def active(self):
+        """
+        Whether syncs are being profiled
+        """
+        return self.remaining > 0 and time.monotonic() < self.deadline
+
+    def call(self, func, *args):
+        """
+        Call func, profiling it if a window is open and no other call
+        is being profiled
+        """
+        if not self.active():
+            return func(*args)
+        if not self.profiling.acquire(blocking=False):
+            with self.lock:
+                self.skipped += 1
+            return func(*args)
+        try:
+            with self.lock:
+                sampled = self.active()
+                self.remaining -= sampled
+            if not sampled:
+                return func(*args)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+                    self.profiled += 1
+        finally:
+            self.profiling.release()
+
+    def state(self):
+        """
+        Progress of the profiling window
+        """
+        with self.lock:
+            return {'active': self.active(),
+                    'profiled': self.profiled,
+                    'skipped': self.skipped,
+                    'remaining': max(self.remaining, 0),
+                    'secondsLeft': round(max(
+                        self.deadline - time.monotonic(), 0), 3)}
+
+    def render(self, fmt='pstats', sort='cumulative', limit=50):
+        """
+        The profile so far, either marshalled pstats data (as written by
+        pstats.Stats.dump_stats) or a text report.  None if no sync has
+        been profiled.
+        """
+        with self.lock:
+            if self.stats is None:
+                return None
+            if fmt == 'pstats':
+                return marshal.dumps(self.stats.stats)
+            out = io.StringIO()
+            report = pstats.Stats(stream=out)
+            report.add(self.stats)
+        report.sort_stats(sort).print_stats(limit)
+        return out.getvalue().encode()
+
+
+class MemoryTracer(object):
+    """
+    tracemalloc for a bounded window.  A snapshot is kept when the window
+    closes so the top allocation sites can still be fetched.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.timer = None
+
+    def start(self, seconds, frames):
+        """
+        Trace allocations for seconds, recording frames deep tracebacks
+        """
+        with self.lock:
+            self.close()
+            self.snapshot = None
+            tracemalloc.start(frames)
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def stop(self):
+        """
+        Stop tracing, keeping a snapshot
+        """
+        with self.lock:
+            self.close()
+
+    def close(self):
+        """
+        Stop tracing with the lock held
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def top(self, key='lineno', limit=25):
+        """
+        Report the top allocation sites, from a live snapshot while
+        tracing.  None if nothing has been traced.
+        """
+        with self.lock:
+            snapshot = (tracemalloc.take_snapshot()
+                        if tracemalloc.is_tracing() else self.snapshot)
+        if snapshot is None:
+            return None
+        snapshot = snapshot.filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),))
+        stats = snapshot.statistics(key)
+        lines = ["tracing: %s, total: %.1f KiB in %d sites" % (
+            tracemalloc.is_tracing(),
+            sum(stat.size for stat in stats) / 1024, len(stats))]
+        for stat in stats[:limit]:
+            lines.append(str(stat))
+            if key == 'traceback':
+                # no source lines - reading them would show up here
+                lines.extend('    %s:%d' % (frame.filename, frame.lineno)
+                             for frame in stat.traceback)
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class RequestLog(object):
+    """
+    The most recent sync requests, to find the slowest of them
+    """
+    def __init__(self, size=256):
+        self.lock = threading.Lock()
+        self.entries = deque(maxlen=size)
+
+    def record(self, entry):
+        """
+        Remember a finished request
+        """
+        with self.lock:
+            self.entries.append(entry)
+
+    def slowest(self, limit=20):
+        """
+        The slowest of the recent requests, slowest first
+        """
+        with self.lock:
+            entries = list(self.entries)
+        return sorted(entries, key=lambda entry: entry['seconds'],
+                      reverse=True)[:limit]
+
+
+# debug endpoints, only served with a --debug-token
+DEBUG_TOKEN = ''
+PROFILER = Profiler()
+MEMORY_TRACER = MemoryTracer()
+REQUEST_LOG = RequestLog()
+PROFILE_SORTS = sorted(pstats.Stats.sort_arg_dict_default)
+TRACE_KEYS = ('lineno', 'filename', 'traceback')
+
+
+def query_int(query, key, default, minimum=1, maximum=None):
+    """
+    Read a positive integer query parameter
+    """
+    value = query.get(key, [default])[0]
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be an integer" % key)
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError("%s must be between %d and %s" % (
+            key, minimum, maximum))
+    return value
+
+
+def debug_response(path, query):
+    """
+    Answer a /debug request - returns (code, body, content type):
+    /debug/profile/start?seconds=&requests= profile the next syncs
+    /debug/profile/stop
+    /debug/profile?format=pstats|text&sort=&limit= the profile so far
+    /debug/memory/start?seconds=&frames= trace allocations
+    /debug/memory/stop
+    /debug/memory?key=lineno|filename|traceback&limit= top allocations
+    /debug/requests?limit= the slowest recent requests
+    """
+    if path == '/debug/profile/start':
+        PROFILER.start(query_int(query, 'seconds', 60, 1, 3600),
+                       query_int(query, 'requests', 100))
+        return 200, JSON_DUMPS(PROFILER.state()), 'application/json'
+    if path == '/debug/profile/stop':
+        PROFILER.stop()
+        return 200, JSON_DUMPS(PROFILER.state()), 'application/json'
+    if path == '/debug/profile':
+        fmt = query.get('format', ['pstats'])[0]
+        sort = query.get('sort', ['cumulative'])[0]
+        if fmt not in ('pstats', 'text') or sort not in PROFILE_SORTS:
+            raise ValueError("format must be pstats or text, sort one of "
+                             "%s" % ', '.join(PROFILE_SORTS))
+        body = PROFILER.render(fmt, sort, query_int(query, 'limit', 50))
+        if body is None:
+            return 404, JSON_DUMPS({'error': 'no profile',
+                                    'profiler': PROFILER.state()}), \
+                'application/json'
+        return 200, body, ('application/octet-stream' if fmt == 'pstats'
+                           else 'text/plain; charset=utf-8')
+    if path == '/debug/memory/start':
+        MEMORY_TRACER.start(query_int(query, 'seconds', 60, 1, 3600),
+                            query_int(query, 'frames', 1, 1, 100))
+        return 200, JSON_DUMPS({'tracing': True}), 'application/json'
+    if path == '/debug/memory/stop':
+        MEMORY_TRACER.stop()
+        return 200, JSON_DUMPS({'tracing': False}), 'application/json'
+    if path == '/debug/memory':
+        key = query.get('key', ['lineno'])[0]
+        if key not in TRACE_KEYS:
+            raise ValueError("key must be one of %s" % ', '.join(TRACE_KEYS))
+        body = MEMORY_TRACER.top(key, query_int(query, 'limit', 25))
+        if body is None:
+            return 404, JSON_DUMPS({'error': 'no trace'}), \
+                'application/json'
+        return 200, body, 'text/plain; charset=utf-8'
+    if path == '/debug/requests':
+        return 200, JSON_DUMPS(REQUEST_LOG.slowest(
+            query_int(query, 'limit', 20))), 'application/json'
+    return 404, b'{}', 'application/json'
+
+
+class Controller(BaseHTTPRequestHandler):
+    """
+    Basic HHTP controller - handles POST requests from the MetaController
+    and GET requests for /stats, /metrics and (with a token) /debug
+    """
+    # headers and body are separate writes - don't let Nagle hold the
+    # body back on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        """
+        pick up the connection handling options of the server
+        """
+        self.protocol_version = self.server.protocol_version
+        self.timeout = self.server.keepalive_timeout
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_request(self, code='-', size='-'):
+        """
+        access log lines go through logging, at DEBUG
+        """
+        if ACCESS_LOG.isEnabledFor(logging.DEBUG):
+            ACCESS_LOG.debug('%s "%s" %s %s', self.address_string(),
+                             self.requestline, getattr(code, 'value', code),
+                             size)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        other http.server messages (errors) go through logging
+        """
+        ACCESS_LOG.warning('%s ' + format, self.address_string(), *args)
+
+    def sync(self, parent, children):  # pylint: disable=no-self-use
+        """
+        Synchronise the incoming MPIJob request by generating
+        Kubernetes object specifications
+        """
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Job in: %s/%s generation %s",
+                          parent.get('metadata', {}).get('namespace'),
+                          parent.get('metadata', {}).get('name'),
+                          parent.get('metadata', {}).get('generation'))
+
+        job_status = timed_call('parse_job', parse_job, children)
+        name, desired_status = observed_workers(children)
+        desired_status['job'] = {'state': job_status['state'],
+                                 'status': job_status['status'],
+                                 'success': job_status['succeeded']}
+        desired_status['phase'] = job_status['state'] or 'Launching'
+        if job_status['initSeconds'] is not None:
+            desired_status['launcherInitSeconds'] = job_status['initSeconds']
+        job = timed_call('parse_mpijob', MPIJob, parent, name,
+                         timed_call('parse_config', parse_config, children),
+                         job_status['name'])
+        now = time.time()
+
+        # spec.runs - one launcher Job after another on the same workers
+        runs = []
+        if job.runs:
+            runs, desired_status['runs'], pending = plan_runs(job,
+                                                              job_status)
+            if pending and job_status['state'] == 'Finished':
+                desired_status['job'] = {'state': 'Running',
+                                         'status': 'Unknown',
+                                         'success': 'Unknown'}
+                desired_status['phase'] = 'Running'
+
+        # elastic - keep only the workers the launcher used
+        used = None
+        if elastic(job) and job_status['usedReplicas'] is not None:
+            used = min(job_status['usedReplicas'], job.replicas)
+            desired_status['usedReplicas'] = used
+
+        # capacity - no workers until the job is admitted
+        desired_status['admission'] = admission_status(
+            job, job_demand(job, used), name)
+        if not desired_status['admission']['admitted']:
+            desired_status['phase'] = 'Queued'
+            desired_status['timestamps'], desired_status['durations'] = \
+                lifecycle(job, (('created', job.created),), now)
+            record_job_state(job, desired_status['job'])
+            return sync_response(desired_status, [], resync_after('Queued'))
+        admitted_at = admitted_time(job, now)
+
+        launch, release, finished_at, resync = worker_gates(
+            job, job_status, desired_status, admitted_at, now)
+        if release:
+            ADMISSION.release(job.uid)
+
+        desired_status['timestamps'], desired_status['durations'] = \
+            lifecycle(job, lifecycle_events(job, job_status, desired_status,
+                                            admitted_at, finished_at), now)
+        rendered = render_children(job, children, runs, launch, release,
+                                   used)
+        record_job_state(job, desired_status['job'])
+        return sync_response(desired_status, rendered, resync)
+
+    def finalize(self, parent, children):  # pylint: disable=no-self-use
+        """
+        The MPIJob is being deleted - give back its capacity and let
+        the MetaController remove the children
+        """
+        del children
+        uid = parent.get('metadata', {}).get('uid')
+        ADMISSION.release(uid)
+        with JOB_STATES_LOCK:
+            JOB_STATES.pop(uid, None)
+        return {'status': parent.get('status') or {},
+                'children': [],
+                'finalized': True}
+
+    def send_busy(self):
+        """
+        tell the MetaController to back off and retry later
+        """
+        self.close_connection = True
+        self.send_response(503)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def send_json(self, code, body, content_type='application/json'):
+        """
+        Send an encoded JSON document, gzipped if the client accepts it
+        """
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        if len(body) >= GZIP_MIN_SIZE >= 0 and \
+           accepts_gzip(self.headers.get('Accept-Encoding')):
+            body = gzip.compress(body, GZIP_LEVEL)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.draining.is_set():
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        the GET responder - controller statistics and metrics
+        """
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self.send_json(200, render_metrics().encode(),
+                           'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/stats':
+            self.send_json(200, JSON_DUMPS({'cache': SYNC_CACHE.stats(),
+                                            'admission': ADMISSION.stats()}))
+        elif path.startswith('/debug/') and DEBUG_TOKEN:
+            self.send_debug(path)
+        else:
+            self.send_json(404, b'{}')
+
+    def send_debug(self, path):
+        """
+        Serve a /debug request to a client that has the debug token
+        """
+        authorization = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(),
+                                   ('Bearer ' + DEBUG_TOKEN).encode()):
+            self.send_json(403, b'{}')
+            return
+        query = parse_qs(self.path.partition('?')[2])
+        try:
+            code, body, content_type = debug_response(path, query)
+        except ValueError as error:
+            code, body, content_type = \
+                400, JSON_DUMPS({'error': str(error)}), 'application/json'
+        logging.info("debug request %s: %d", self.path, code)
+        self.send_json(code, body, content_type)
+
+# we only handle POST requests
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        the POST responder...
+        """
+        start = time.perf_counter()
+        SYNC_IN_FLIGHT.inc(1)
+        sample_payloads()
+        code = 500
+        length = sent = 0
+        job = None
+        try:
+            if not self.server.acquire():
+                logging.warning("sync slots exhausted - rejecting request")
+                code = 503
+                self.send_busy()
+                return
+            try:
+                length = int(self.headers.get('content-length'))
+                SYNC_REQUEST_BYTES.observe(length)
+                with timed_stage('decode'):
+                    body = read_body(self.rfile, length)
+                    if self.headers.get('Content-Encoding',
+                                        '').lower() == 'gzip':
+                        body = gzip.decompress(body)
+                    elif JSON_LOADS is json.loads:
+                        body = body.tobytes()
+                    observed = JSON_LOADS(body)
+                    del body
+                metadata = observed['parent'].get('metadata', {})
+                job = '%s/%s' % (metadata.get('namespace'),
+                                 metadata.get('name'))
+                hook = (self.finalize
+                        if self.path.split('?')[0] == '/finalize'
+                        else self.sync)
+                desired = PROFILER.call(hook, observed['parent'],
+                                        observed['children'])
+                # encoded once - the same bytes are logged and sent
+                with timed_stage('encode'):
+                    body = JSON_DUMPS(desired)
+                SYNC_RESPONSE_BYTES.observe(len(body))
+                log_payload("out", body)
+                code = 200
+            except InvalidJob as error:
+                logging.error("invalid MPIJob: %s", error)
+                code = 422
+                body = JSON_DUMPS({'error': str(error)})
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("sync failed")
+                body = JSON_DUMPS({'error': 'sync failed'})
+            finally:
+                self.server.release()
+            sent = len(body)
+            self.send_json(code, body)
+        finally:
+            seconds = time.perf_counter() - start
+            SYNC_IN_FLIGHT.inc(-1)
+            SYNC_REQUESTS.inc(1, str(code))
+            SYNC_SECONDS.observe(seconds)
+            REQUEST_LOG.record({'time': format_time(time.time()),
+                                'path': self.path,
+                                'job': job,
+                                'code': code,
+                                'seconds': round(seconds, 6),
+                                'requestBytes': length,
+                                'responseBytes': sent})
+
+
+class SyncServer(HTTPServer):
+    """
+    Serial HTTP/1.0 server - one request at a time
+    """
+    protocol_version = 'HTTP/1.0'
+
+    def __init__(self, address, handler, max_inflight=1,
+                 queue_timeout=0, keepalive_timeout=None):
+        HTTPServer.__init__(self, address, handler)
+        self.keepalive_timeout = keepalive_timeout
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.draining = threading.Event()
+        self.inflight = 0
+        self.idle = threading.Condition()
+
+    def acquire(self):
+        """
+        Claim a sync slot, waiting at most queue_timeout seconds
+        """
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            return False
+        with self.idle:
+            self.inflight += 1
+        return True
+
+    def release(self):
+        """
+        Give back a sync slot claimed by acquire
+        """
+        with self.idle:
+            self.inflight -= 1
+            self.idle.notify_all()
+        self.slots.release()
+
+    def drain(self, timeout):
+        """
+        Wait for in-flight requests to complete
+        """
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.inflight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.warning("drain timed out with %d in flight",
+                                    self.inflight)
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+
+class ThreadedSyncServer(ThreadingMixIn, SyncServer):
+    """
+    Concurrent HTTP/1.1 keep-alive server - a thread per connection,
+    with at most max_inflight syncs running at once
+    """
+    protocol_version = 'HTTP/1.1'
+    daemon_threads = True
+    request_queue_size = 128
+
+
+SERVERS = {'simple': SyncServer,
+           'threaded': ThreadedSyncServer}
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='MPIJob sync hook for the MetaController')
+    parser.add_argument('kubectl_image', nargs='?', default=KUBECTL_IMAGE,
+                        help='kubectl delivery image for the launcher')
+    parser.add_argument('--server', choices=sorted(SERVERS),
+                        default='simple',
+                        help='serving engine (default: simple)')
+    parser.add_argument('--port', type=int, default=80,
+                        help='port to listen on (default: 80)')
+    parser.add_argument('--max-inflight', type=int, default=8,
+                        help='maximum concurrent syncs (threaded only)')
+    parser.add_argument('--queue-timeout', type=float, default=5.0,
+                        help='seconds a request may wait for a sync slot '
+                        'before it is rejected with 503 (threaded only)')
+    parser.add_argument('--keepalive-timeout', type=float, default=30.0,
+                        help='seconds an idle keep-alive connection is held '
+                        'open (threaded only)')
+    parser.add_argument('--drain-timeout', type=float, default=20.0,
+                        help='seconds to wait for in-flight requests '
+                        'on SIGTERM')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='maximum number of cached sync results, '
+                        '0 disables the cache (default: 1024)')
+    parser.add_argument('--cache-ttl', type=float, default=300.0,
+                        help='seconds a cached sync result is reused '
+                        '(default: 300)')
+    parser.add_argument('--rbac-mode', choices=RBAC_MODES,
+                        default=RBAC_MODE,
+                        help='launcher Role rules: names restricts get and '
+                        'exec to the worker Pods by name (list covers every '
+                        'Pod in the namespace), compact does not grow with '
+                        'replicas (default: %s)' % RBAC_MODE)
+    parser.add_argument('--json-backend',
+                        choices=['auto'] + sorted(JSON_BACKENDS),
+                        default='auto',
+                        help='JSON encoder/decoder, auto prefers orjson '
+                        'when it is installed (default: auto)')
+    parser.add_argument('--gzip-min-size', type=int, default=GZIP_MIN_SIZE,
+                        help='gzip responses of at least this many bytes '
+                        'when the client accepts it, -1 disables (default: '
+                        '%d)' % GZIP_MIN_SIZE)
+    parser.add_argument('--gzip-level', type=int, default=GZIP_LEVEL,
+                        choices=range(1, 10), metavar='{1..9}',
+                        help='gzip compression level (default: %d)' %
+                        GZIP_LEVEL)
+    parser.add_argument('--resync-intervals', type=parse_intervals,
+                        default=RESYNC_INTERVALS, metavar='PHASE=SECONDS,..',
+                        help='seconds between resyncs of MPIJobs that are '
+                        'queued, scaling, launching, running or finished, 0 '
+                        'leaves resyncs to the MetaController (default: %s)' %
+                        ','.join('%s=%s' % item for item in
+                                 sorted(RESYNC_INTERVALS.items())))
+    parser.add_argument('--resync-jitter', type=float, default=RESYNC_JITTER,
+                        help='fraction of each resync interval to randomly '
+                        'add or take away (default: %s)' % RESYNC_JITTER)
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='worker slots (replicas x slots) that admitted '
+                        'MPIJobs may hold, 0 admits every job (default: 0)')
+    parser.add_argument('--capacity-scope', choices=['cluster', 'namespace'],
+                        default='cluster',
+                        help='apply --capacity to the whole cluster or to '
+                        'each namespace (default: cluster)')
+    parser.add_argument('--admission-warmup', type=float, default=70.0,
+                        help='seconds after start before new MPIJobs are '
+                        'admitted, for running jobs to be counted again '
+                        '(default: 70)')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help='log level (default: INFO)')
+    parser.add_argument('--log-format', choices=['text', 'json'],
+                        default='text',
+                        help='text lines or one JSON document per line '
+                        '(default: text)')
+    parser.add_argument('--log-payload-every', type=int,
+                        default=PAYLOAD_LOG_EVERY,
+                        help='at DEBUG, log the documents of one sync in N, '
+                        '0 for none (default: %d)' % PAYLOAD_LOG_EVERY)
+    parser.add_argument('--log-payload-bytes', type=int,
+                        default=PAYLOAD_LOG_BYTES,
+                        help='cut logged documents to this many bytes, '
+                        '0 for no limit (default: %d)' % PAYLOAD_LOG_BYTES)
+    parser.add_argument('--debug-token',
+                        default=os.environ.get('MPI_DEBUG_TOKEN', ''),
+                        help='bearer token for the /debug profiling '
+                        'endpoints, which are off without one '
+                        '(default: $MPI_DEBUG_TOKEN)')
+    return parser.parse_args(argv)
+
+
+def serve(args):
+    """
+    Run the web server until SIGTERM/SIGINT, then drain
+    """
+    if args.server == 'threaded':
+        server = ThreadedSyncServer(('', args.port), Controller,
+                                    max_inflight=args.max_inflight,
+                                    queue_timeout=args.queue_timeout,
+                                    keepalive_timeout=args.keepalive_timeout)
+    else:
+        server = SyncServer(('', args.port), Controller)
+
+    def stop(signum, _):
+        logging.info("received signal %d - draining", signum)
+        server.draining.set()
+        # shutdown() blocks until serve_forever() returns, so it
+        # cannot be called from the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info("%s server listening on port %d", args.server, args.port)
+    server.serve_forever()
+    server.drain(args.drain_timeout)
+    server.server_close()
+    logging.info("server stopped")
+
+
+def main(argv=None):
+    """
+    boot the web server
+    """
+    # pylint: disable=global-statement
+    global KUBECTL_IMAGE, SYNC_CACHE, ADMISSION, JSON_LOADS, JSON_DUMPS
+    global GZIP_MIN_SIZE, GZIP_LEVEL, RBAC_MODE
+    global RESYNC_INTERVALS, RESYNC_JITTER, DEBUG_TOKEN
+    global PAYLOAD_LOG_EVERY, PAYLOAD_LOG_BYTES
+    args = parse_args(argv)
+    listener = configure_logging(args.log_level, args.log_format)
+    PAYLOAD_LOG_EVERY = args.log_payload_every
+    PAYLOAD_LOG_BYTES = args.log_payload_bytes
+    DEBUG_TOKEN = args.debug_token
+    KUBECTL_IMAGE = args.kubectl_image
+    RBAC_MODE = args.rbac_mode
+    RESYNC_INTERVALS = args.resync_intervals
+    RESYNC_JITTER = args.resync_jitter
+    if args.json_backend != 'auto':
+        JSON_LOADS, JSON_DUMPS = JSON_BACKENDS[args.json_backend]
+    GZIP_MIN_SIZE = args.gzip_min_size
+    GZIP_LEVEL = args.gzip_level
+    SYNC_CACHE = SyncCache(args.cache_size, args.cache_ttl)
+    ADMISSION = AdmissionLedger(args.capacity,
+                                args.capacity_scope == 'namespace',
+                                args.admission_warmup)
+    try:
+        serve(args)
+    finally:
+        # write out what is still queued
+        listener.stop()
 
 
-# boot the web server
-HTTPServer(('', 80), Controller).serve_forever()
+if __name__ == '__main__':
+    main()